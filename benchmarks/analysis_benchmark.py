@@ -0,0 +1,275 @@
+#End-to-end benchmark of the analysis and playlist routes against the local stand-in Spotify API (fake_spotify.py)
+#Usage: python benchmarks/analysis_benchmark.py [--scenarios small,medium,large] [--latency 0.02] [--throttle-rate 0.01]
+#Measures analysis time, API calls, peak memory and route latency per scenario. Results are saved as JSON in
+#benchmarks/results/ and compared with the newest earlier results file, so regressions between versions show up
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+#Scenario name -> (playlists, tracks per playlist)
+SCENARIOS = {
+    'small': (10, 100),
+    'medium': (100, 100),
+    'large': (1000, 100),
+    'long-playlists': (10, 10000),
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis and playlist routes against a fake Spotify API")
+    parser.add_argument("--scenarios", default="small,medium,large", help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--overlap", type=float, default=0.2, help="share of each playlist's tracks also in other playlists")
+    parser.add_argument("--artist-ratio", type=float, default=0.3, help="distinct artists per distinct track")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API response")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of API requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--rate-limit", type=float, default=1000, help="the app's RATE_LIMIT_PER_SECOND during the run")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per route latency, the median is reported")
+    parser.add_argument("--no-save", action="store_true", help="don't write a results file")
+    return parser.parse_args()
+
+def start_fake_spotify():
+    #Runs in its own process so its work doesn't show up in this process's timings and memory
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "fake_spotify.py")], stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+def load_app(fake_url, rate_limit):
+    #The app reads its settings when imported, so they are set first. A fresh cache database keeps runs independent
+    os.environ.update({
+        'SPOTIFY_API_URL': fake_url + "/v1",
+        'SPOTIFY_ACCOUNTS_URL': fake_url,
+        'CACHE_DB_PATH': os.path.join(tempfile.mkdtemp(), "benchmark_cache.sqlite3"),
+        'RATE_LIMIT_PER_SECOND': str(rate_limit),
+        'RATE_LIMIT_BURST': str(rate_limit),
+        'LOG_LEVEL': "WARNING",
+    })
+    sys.path.insert(0, REPO_DIR)
+    import playlistMaker
+    playlistMaker.app.secret_key = playlistMaker.app.secret_key or "benchmark"
+    return playlistMaker
+
+def reset_app(pm):
+    #Forgets cached artists, playlists, analyses and their snapshots, search pages and rate limiter state between measurements
+    conn = pm.cache_db()
+    conn.execute("DELETE FROM artist_genres")
+    conn.execute("DELETE FROM playlist_pages")
+    conn.execute("DELETE FROM playlist_contents")
+    conn.execute("DELETE FROM analysis_snapshots")
+    conn.execute("DELETE FROM rate_limit")
+    pm.genre_data_cache = pm.create_cache("genre_data", pm.ANALYSIS_CACHE_MAX_BYTES, pm.ANALYSIS_CACHE_MAX_IDLE)
+    pm.search_cache = pm.create_cache("search", pm.SEARCH_CACHE_MAX_BYTES, pm.SEARCH_CACHE_TTL, pm.SEARCH_CACHE_TTL)
+    with pm.jobs_lock:
+        pm.analysis_jobs.clear()
+
+def ignore_progress(event, **fields):
+    pass
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def run_scenario(pm, fake_url, name, args):
+    playlists, tracks_per_playlist = SCENARIOS[name]
+    settings = {
+        'library': {
+            'playlists': playlists,
+            'tracks_per_playlist': tracks_per_playlist,
+            'overlap': args.overlap,
+            'artist_ratio': args.artist_ratio,
+        },
+        'latency': args.latency,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+    }
+
+    def start_run():
+        reset_app(pm)
+        requests.post(fake_url + "/_benchmark", json=settings).raise_for_status()
+
+    def api_calls():
+        return requests.get(fake_url + "/_benchmark").json()['calls']
+
+    with pm.app.test_request_context():
+        sp = pm.get_spotify({'access_token': "benchmark"})
+
+    #Full analysis from an empty artist cache, timed
+    start_run()
+    genre_data, analysis_seconds = timed(pm.analyse_genres, sp, progress=ignore_progress)
+    calls = api_calls()
+
+    #Refresh with no playlist changed, served from the previous result
+    _, refresh_seconds = timed(pm.analyse_genres, sp, previous=genre_data, progress=ignore_progress)
+
+    #Full analysis of another user following the same playlists, served from the shared playlist and artist caches
+    calls_before = sum(api_calls().values())
+    _, shared_seconds = timed(pm.analyse_genres, sp, progress=ignore_progress)
+    shared_calls = sum(api_calls().values()) - calls_before
+
+    #The same full analysis again under tracemalloc, which slows it down too much to time it at the same time.
+    #Working memory is the peak minus what the result keeps, the part that streaming keeps bounded
+    start_run()
+    tracemalloc.start()
+    result = pm.analyse_genres(sp, progress=ignore_progress)
+    retained_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    #Routes as a logged in user would call them
+    start_run()
+    routes = measure_routes(pm, args.repeat)
+
+    return {
+        'playlists': playlists,
+        'tracks': playlists * tracks_per_playlist,
+        'genres': len(genre_data['genres']),
+        'analysis_seconds': round(analysis_seconds, 4),
+        'refresh_seconds': round(refresh_seconds, 4),
+        'shared_seconds': round(shared_seconds, 4),
+        'shared_api_calls_total': shared_calls,
+        'api_calls': calls,
+        'api_calls_total': sum(calls.values()),
+        'route_api_calls_total': sum(api_calls().values()),
+        'peak_memory_bytes': peak_memory,
+        'working_memory_bytes': peak_memory - retained_memory,
+        'routes': routes,
+    }
+
+def measure_routes(pm, repeat):
+    #Seconds per route, the median of repeat requests where a route can be repeated
+    client = pm.app.test_client()
+    with client.session_transaction() as session:
+        session[pm.TOKEN_INFO] = {'access_token': "benchmark", 'refresh_token': "benchmark", 'expires_at': time.time() + 24 * 3600}
+    routes = {}
+
+    def median(path, **kwargs):
+        samples = []
+        for _ in range(repeat):
+            response, seconds = timed(client.get, path, **kwargs)
+            assert response.status_code in (200, 302, 304), (path, response.status_code)
+            samples.append(seconds)
+        return round(statistics.median(samples), 5)
+
+    def wait_for_job(page):
+        #Polls the job a progress or success page shows until it has finished
+        job_id = re.search(r'/jobs/(\w+)', page).group(1)
+        while True:
+            job = client.get(f"/jobs/{job_id}").get_json()
+            if job['status'] != 'running':
+                assert job['status'] == 'done', job['error']
+                return
+            time.sleep(0.005)
+
+    #First dashboard load starts the analysis job, it is done once the dashboard renders
+    start = time.perf_counter()
+    response = client.get("/dashboard")
+    wait_for_job(response.get_data(as_text=True))
+    response = client.get("/dashboard")
+    routes['dashboard_first_load'] = round(time.perf_counter() - start, 4)
+    etag = response.headers.get('ETag')
+    routes['dashboard'] = median("/dashboard")
+    routes['dashboard_not_modified'] = median("/dashboard", headers={'If-None-Match': etag})
+    #A restarted worker starts with an empty analysis cache and loads the saved snapshot instead of analysing again
+    pm.genre_data_cache = pm.create_cache("genre_data", pm.ANALYSIS_CACHE_MAX_BYTES, pm.ANALYSIS_CACHE_MAX_IDLE)
+    response, routes['dashboard_after_restart'] = timed(client.get, "/dashboard")
+    assert 'Analysing' not in response.get_data(as_text=True)
+    routes['genre_data'] = median("/api/genre-data")
+    top_genre = client.get("/api/genre-data").get_json()['labels'][0]
+
+    response, routes['create_genre_playlist'] = timed(client.get, "/create-genre-playlist", query_string={'genre': top_genre})
+    _, routes['create_genre_playlist_job'] = timed(wait_for_job, response.get_data(as_text=True))
+    response, routes['create_genre_playlists'] = timed(client.get, "/create-genre-playlists", query_string={'top': 10})
+    _, routes['create_genre_playlists_job'] = timed(wait_for_job, response.get_data(as_text=True))
+
+    _, routes['search_new_songs'] = timed(client.get, "/search-new-songs", query_string={'genre': top_genre})
+    routes['search_new_songs_cached'] = median("/search-new-songs", query_string={'genre': top_genre})
+    #A Spotify request that raised is counted with status "error" next to the numeric statuses, /metrics renders both
+    pm.metrics.inc('spotify_requests_total', endpoint="/v1/me/playlists", method="GET", status='error')
+    routes['metrics'] = median("/metrics")
+    return {route: round(seconds, 5) for route, seconds in routes.items()}
+
+def print_scenario(name, result):
+    print(f"\n{name}: {result['playlists']} playlists, {result['tracks']} tracks, {result['genres']} genres")
+    print(f"  analysis         {result['analysis_seconds']:10.3f} s")
+    print(f"  refresh          {result['refresh_seconds']:10.3f} s")
+    print(f"  shared playlists {result['shared_seconds']:10.3f} s  ({result['shared_api_calls_total']} API calls)")
+    print(f"  peak memory      {result['peak_memory_bytes'] / 1024 / 1024:10.1f} MiB")
+    print(f"  working memory   {result['working_memory_bytes'] / 1024 / 1024:10.1f} MiB")
+    print(f"  API calls        {result['api_calls_total']:10d}  " + ", ".join(f"{endpoint}: {count}" for endpoint, count in sorted(result['api_calls'].items())))
+    for route, seconds in result['routes'].items():
+        print(f"  {route:<28} {seconds * 1000:10.1f} ms")
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def latest_results():
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    names = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith(".json"))
+    if not names:
+        return None
+    with open(os.path.join(RESULTS_DIR, names[-1])) as f:
+        return json.load(f)
+
+def compare(previous, current):
+    #Change of every number against the previous results, for the scenarios both have
+    print(f"\nCompared with {previous['version']} ({previous['timestamp']}):")
+    if previous['settings'] != current['settings']:
+        print("  (run with different settings, differences may not be regressions)")
+    for name, result in current['scenarios'].items():
+        before = previous['scenarios'].get(name)
+        if not before:
+            continue
+        pairs = [(metric, before.get(metric), result[metric]) for metric in ('analysis_seconds', 'refresh_seconds', 'shared_seconds', 'api_calls_total', 'peak_memory_bytes', 'working_memory_bytes')]
+        pairs += [(route, before.get('routes', {}).get(route), seconds) for route, seconds in result['routes'].items()]
+        print(f"  {name}:")
+        for metric, old, new in pairs:
+            if old:
+                print(f"    {metric:<28} {old:>14} -> {new:<14} {(new - old) / old * 100:+7.1f}%")
+
+def main():
+    args = parse_args()
+    process, fake_url = start_fake_spotify()
+    try:
+        pm = load_app(fake_url, args.rate_limit)
+        results = {
+            'version': git_version(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'settings': {name: value for name, value in vars(args).items() if name not in ('scenarios', 'no_save')},
+            'scenarios': {},
+        }
+        for name in args.scenarios.split(","):
+            results['scenarios'][name] = run_scenario(pm, fake_url, name, args)
+            print_scenario(name, results['scenarios'][name])
+        #Search page prefetches still running would otherwise fail once the fake API stops
+        pm.prefetch_executor.shutdown(wait=True)
+    finally:
+        process.terminate()
+
+    previous = latest_results()
+    if previous:
+        compare(previous, results)
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['version']}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#Local stand-in for the parts of the Spotify Web API and accounts service the app uses, serving a synthetic library
+#Usage: python benchmarks/fake_spotify.py [port]
+#then run the app with SPOTIFY_API_URL=http://127.0.0.1:<port>/v1 and SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:<port>
+#The library, latency and 429 injection are set by POSTing settings to /_benchmark/library (see Library and FakeSpotify)
+import sys
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+USER_ID = "benchmark-user"
+GENRE_WORDS = ["indie", "rock", "pop", "dance", "uk", "alternative", "hip hop", "metal", "folk", "electro", "deep", "soul"]
+
+class Library:
+    #Synthetic library of playlists. overlap is the share of each playlist's tracks taken from tracks already in
+    #other playlists, artist_ratio is distinct artists per distinct track (lower means more tracks share an artist)
+    def __init__(self, playlists=10, tracks_per_playlist=100, overlap=0.2, artist_ratio=0.3, genres=400, seed=42):
+        rng = random.Random(seed)
+        genre_names = [f"{rng.choice(GENRE_WORDS)} {rng.choice(GENRE_WORDS)} {i}" for i in range(genres)]
+        unique_tracks = max(1, int(playlists * tracks_per_playlist * (1 - overlap)))
+        artist_count = max(1, int(unique_tracks * artist_ratio))
+        #Some artists have no genres, like on Spotify
+        self.artists = [rng.sample(genre_names, rng.randint(0, 4)) for _ in range(artist_count)]
+        self.track_artists = [rng.randrange(artist_count) for _ in range(unique_tracks)]
+        self.playlists = []
+        next_track = 0
+        for _ in range(playlists):
+            tracks = []
+            for _ in range(tracks_per_playlist):
+                if next_track < unique_tracks and (next_track == 0 or rng.random() >= overlap):
+                    tracks.append(next_track)
+                    next_track += 1
+                else:
+                    tracks.append(rng.randrange(max(next_track, 1)))
+            self.playlists.append(tracks)
+        self.created = {} #Playlist ID -> track URIs added by the app
+
+    @staticmethod
+    def track_id(index):
+        return f"tr{index:020d}"
+
+    @staticmethod
+    def artist_id(index):
+        return f"ar{index:020d}"
+
+    @staticmethod
+    def playlist_id(index):
+        return f"pl{index:020d}"
+
+class FakeSpotify(ThreadingHTTPServer):
+    #latency seconds are added to every API response, throttle_rate is the share of API requests answered with a 429
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.library = Library()
+        self.latency = 0.0
+        self.throttle_rate = 0.0
+        self.retry_after = 1
+        self.calls = Counter() #"METHOD /path/{id}" -> requests, including throttled ones
+        self._rng = random.Random(0)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def configure(self, settings):
+        #Replaces the library and resets the call counts for the next benchmark run
+        library = Library(**settings.get('library', {}))
+        with self._lock:
+            self.library = library
+            self.latency = settings.get('latency', 0.0)
+            self.throttle_rate = settings.get('throttle_rate', 0.0)
+            self.retry_after = settings.get('retry_after', 1)
+            self.calls = Counter()
+
+    def handle_error(self, request, client_address):
+        #Clients closing keep-alive connections at exit are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, endpoint):
+        #Counts the call and decides whether to throttle it
+        with self._lock:
+            self.calls[endpoint] += 1
+            return self._rng.random() < self.throttle_rate
+
+class Handler(BaseHTTPRequestHandler):
+    #Keep-alive, so the app's pooled connections are reused as they would be against the real API
+    protocol_version = "HTTP/1.1"
+    #Headers and body are written separately, without this small responses wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self, method):
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        #The accounts service takes form posts, the Web API JSON
+        if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            body = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+        elif body:
+            body = json.loads(body)
+
+        #Benchmark control and accounts service endpoints, neither counted nor delayed
+        if parts[:1] == ['_benchmark']:
+            if method == "POST":
+                self.server.configure(body or {})
+            return self.send_json({'calls': dict(self.server.calls)})
+        if parts == ['authorize']:
+            location = query['redirect_uri'] + '?' + urlencode({'code': 'benchmark', 'state': query.get('state', '')})
+            return self.send_json({}, 302, {'Location': location})
+        if parts == ['api', 'token']:
+            return self.send_json({
+                'access_token': 'benchmark', 'token_type': 'Bearer', 'expires_in': 3600,
+                'refresh_token': 'benchmark', 'scope': ''
+            })
+
+        if parts[:1] != ['v1']:
+            return self.send_json({'error': {'status': 404, 'message': 'Not found'}}, 404)
+        parts = parts[1:]
+        endpoint = method + " /v1/" + "/".join(
+            part if part in ('me', 'users', 'playlists', 'items', 'tracks', 'artists', 'search') else '{id}' for part in parts
+        )
+        if self.server.count(endpoint):
+            return self.send_json(
+                {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, 429,
+                {'Retry-After': str(self.server.retry_after)}
+            )
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        library = self.server.library
+        if method == "GET" and parts == ['me']:
+            return self.send_json({'id': USER_ID, 'display_name': 'Benchmark User'})
+        if method == "GET" and parts == ['me', 'playlists']:
+            return self.send_page(range(len(library.playlists)), query, 50, lambda i: {
+                'id': Library.playlist_id(i), 'name': f"Playlist {i}", 'snapshot_id': f"snapshot{i}",
+                'tracks': {'total': len(library.playlists[i])}
+            })
+        if method == "GET" and len(parts) == 3 and parts[0] == 'playlists' and parts[2] in ('items', 'tracks'):
+            return self.send_page(library.playlists[int(parts[1][2:])], query, 100, lambda track: {'track': {
+                'id': Library.track_id(track),
+                'uri': 'spotify:track:' + Library.track_id(track),
+                'artists': [{'id': Library.artist_id(library.track_artists[track])}]
+            }})
+        if method == "GET" and parts == ['artists']:
+            ids = query.get('ids', '').split(',')
+            return self.send_json({'artists': [
+                {'id': artist_id, 'name': 'Artist ' + artist_id[-6:], 'genres': library.artists[int(artist_id[2:])]}
+                for artist_id in ids
+            ]})
+        if method == "GET" and parts == ['search']:
+            page = self.page(range(min(len(library.track_artists), 1000)), query, 50, lambda track: {
+                'uri': 'spotify:track:' + Library.track_id(track), 'name': f"Track {track}",
+                'artists': [{'name': f"Artist {library.track_artists[track]}"}]
+            })
+            return self.send_json({'tracks': page})
+        if method == "POST" and len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+            playlist_id = f"new{len(library.created):019d}"
+            library.created[playlist_id] = []
+            return self.send_json({'id': playlist_id, 'external_urls': {'spotify': f"{self.server.url}/playlist/{playlist_id}"}}, 201)
+        if method == "POST" and len(parts) == 3 and parts[0] == 'playlists' and parts[2] in ('items', 'tracks'):
+            tracks = library.created.setdefault(parts[1], [])
+            position = int(query.get('position', len(tracks)))
+            tracks[position:position] = body['uris'] if isinstance(body, dict) else body
+            return self.send_json({'snapshot_id': f"snapshot{len(tracks)}"}, 201)
+        return self.send_json({'error': {'status': 404, 'message': 'Not found'}}, 404)
+
+    def page(self, entries, query, default_limit, make_item):
+        #Paging object with limit/offset and an absolute next URL like the Web API's, only the page's items are built
+        limit = int(query.get('limit', default_limit))
+        offset = int(query.get('offset', 0))
+        next_url = None
+        if offset + limit < len(entries):
+            url = urlsplit(self.path)
+            next_url = f"{self.server.url}{url.path}?" + urlencode({**query, 'offset': offset + limit, 'limit': limit})
+        items = [make_item(entry) for entry in entries[offset:offset+limit]]
+        return {'items': items, 'total': len(entries), 'limit': limit, 'offset': offset, 'next': next_url}
+
+    def send_page(self, entries, query, default_limit, make_item):
+        return self.send_json(self.page(entries, query, default_limit, make_item))
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == "__main__":
+    server = FakeSpotify(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    #The benchmark reads the chosen port from this line
+    print(server.url, flush=True)
+    server.serve_forever()
@@ -0,0 +1,56 @@
+#Compares the memory held by the old list of (genre, uri) tuples with the columnar TrackGenreTable
+#Usage: python benchmarks/memory_benchmark.py [number of tracks]
+import os
+import sys
+import random
+import string
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from playlistMaker import TrackGenreTable, GenreIndex
+
+def synthetic_library(track_count, artist_count=3000, genre_count=800, seed=42):
+    #Builds (uri, genres) rows shaped like a real library: multi-genre artists shared by many tracks
+    rng = random.Random(seed)
+    words = ["indie", "rock", "pop", "dance", "uk", "alternative", "hip hop", "metal", "folk", "electro", "deep", "soul"]
+    genres = [f"{rng.choice(words)} {rng.choice(words)} {i}" for i in range(genre_count)]
+    artist_genres = [rng.sample(genres, rng.randint(1, 6)) for _ in range(artist_count)]
+    rows = []
+    for _ in range(track_count):
+        uri = "spotify:track:" + "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+        rows.append((uri, artist_genres[rng.randrange(artist_count)]))
+    return rows
+
+def measure(build, rows):
+    #Returns (result, bytes allocated by build that are still alive)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def build_tuples(rows):
+    #The representation analyse_genres used to return
+    return [(genre, uri) for uri, genres in rows for genre in genres]
+
+def build_table(rows):
+    table = TrackGenreTable()
+    for uri, genres in rows:
+        table.add_track(uri, genres)
+    return table
+
+if __name__ == "__main__":
+    track_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rows = synthetic_library(track_count)
+    
+    #Both builds reuse the same URI and genre string objects, so only the container cost is compared
+    tuples, tuples_bytes = measure(build_tuples, rows)
+    table, table_bytes = measure(build_table, rows)
+    assert list(table) == tuples
+    _, index_bytes = measure(GenreIndex, table)
+    
+    print(f"Tracks: {track_count}, (genre, uri) pairs: {len(tuples)}")
+    print(f"List of tuples:   {tuples_bytes / 1024:10.1f} KiB")
+    print(f"TrackGenreTable:  {table_bytes / 1024:10.1f} KiB  ({tuples_bytes / max(table_bytes, 1):.1f}x smaller)")
+    print(f"GenreIndex:       {index_bytes / 1024:10.1f} KiB")
@@ -0,0 +1,108 @@
+#Compares the size and parse time of a full playlist items page with the field-filtered page the analysis requests
+#Usage: python benchmarks/payload_benchmark.py
+import os
+import sys
+import json
+import time
+import random
+import string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from playlistMaker import PLAYLIST_ITEMS_PAGE_SIZE, track_rows
+
+MARKETS = ["AD", "AE", "AG", "AL", "AM", "AO", "AR", "AT", "AU", "AZ", "BA", "BB", "BD", "BE", "BF", "BG", "BH", "BI",
+           "BJ", "BN", "BO", "BR", "BS", "BT", "BW", "BY", "BZ", "CA", "CD", "CG", "CH", "CI", "CL", "CM", "CO", "CR",
+           "CV", "CW", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO", "DZ", "EC", "EE", "EG", "ES", "ET", "FI", "FJ", "FM",
+           "FR", "GA", "GB", "GD", "GE", "GH", "GM", "GN", "GQ", "GR", "GT", "GW", "GY", "HK", "HN", "HR", "HT", "HU",
+           "ID", "IE", "IL", "IN", "IQ", "IS", "IT", "JM", "JO", "JP", "KE", "KG", "KH", "KI", "KM", "KN", "KR", "KW"]
+
+def spotify_id(rng):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+def artist(rng):
+    artist_id = spotify_id(rng)
+    return {
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id}"},
+        "href": f"https://api.spotify.com/v1/artists/{artist_id}",
+        "id": artist_id,
+        "name": "Artist " + artist_id[:6],
+        "type": "artist",
+        "uri": f"spotify:artist:{artist_id}"
+    }
+
+def full_item(rng):
+    #Shape of an unfiltered playlist item as returned by the Web API
+    track_id, album_id = spotify_id(rng), spotify_id(rng)
+    artists = [artist(rng) for _ in range(rng.randint(1, 3))]
+    return {
+        "added_at": "2024-05-01T12:00:00Z",
+        "added_by": {"id": "someone", "type": "user", "uri": "spotify:user:someone",
+                     "href": "https://api.spotify.com/v1/users/someone",
+                     "external_urls": {"spotify": "https://open.spotify.com/user/someone"}},
+        "is_local": False,
+        "primary_color": None,
+        "video_thumbnail": {"url": None},
+        "track": {
+            "album": {
+                "album_type": "album",
+                "artists": artists[:1],
+                "available_markets": MARKETS,
+                "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id}"},
+                "href": f"https://api.spotify.com/v1/albums/{album_id}",
+                "id": album_id,
+                "images": [{"height": size, "width": size, "url": f"https://i.scdn.co/image/{spotify_id(rng)}"}
+                           for size in (640, 300, 64)],
+                "name": "Album " + album_id[:6],
+                "release_date": "2020-01-01",
+                "release_date_precision": "day",
+                "total_tracks": 12,
+                "type": "album",
+                "uri": f"spotify:album:{album_id}"
+            },
+            "artists": artists,
+            "available_markets": MARKETS,
+            "disc_number": 1,
+            "duration_ms": rng.randint(120000, 300000),
+            "episode": False,
+            "explicit": False,
+            "external_ids": {"isrc": "GB" + spotify_id(rng)[:10].upper()},
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+            "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "id": track_id,
+            "is_local": False,
+            "name": "Track " + track_id[:6],
+            "popularity": rng.randint(0, 100),
+            "preview_url": None,
+            "track": True,
+            "track_number": rng.randint(1, 12),
+            "type": "track",
+            "uri": f"spotify:track:{track_id}"
+        }
+    }
+
+def filtered_item(item):
+    #What the same item looks like with PLAYLIST_ITEM_FIELDS applied
+    track = item["track"]
+    return {"track": {"id": track["id"], "uri": track["uri"], "artists": [{"id": a["id"]} for a in track["artists"]]}}
+
+def parse_time(body, repeats=200):
+    #Average seconds to decode a page and turn it into analysis rows
+    start = time.perf_counter()
+    for _ in range(repeats):
+        track_rows(json.loads(body)["items"])
+    return (time.perf_counter() - start) / repeats
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    items = [full_item(rng) for _ in range(PLAYLIST_ITEMS_PAGE_SIZE)]
+    full_page = json.dumps({"items": items, "next": "https://api.spotify.com/v1/playlists/x/items?offset=100"})
+    filtered_page = json.dumps({"items": [filtered_item(item) for item in items],
+                                "next": "https://api.spotify.com/v1/playlists/x/items?offset=100"})
+    assert track_rows(json.loads(full_page)["items"]) == track_rows(json.loads(filtered_page)["items"])
+    
+    full_time, filtered_time = parse_time(full_page), parse_time(filtered_page)
+    print(f"Page of {PLAYLIST_ITEMS_PAGE_SIZE} items")
+    print(f"Full page:     {len(full_page) / 1024:8.1f} KiB, parsed in {full_time * 1000:6.2f} ms")
+    print(f"Filtered page: {len(filtered_page) / 1024:8.1f} KiB, parsed in {filtered_time * 1000:6.2f} ms")
+    print(f"Saved {100 * (1 - len(filtered_page) / len(full_page)):.0f}% of bytes and "
+          f"{100 * (1 - filtered_time / full_time):.0f}% of parse time per page")
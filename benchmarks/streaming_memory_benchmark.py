@@ -0,0 +1,51 @@
+#Checks that the analysis's working memory (peak minus what its result keeps) doesn't grow with playlist size
+#Usage: python benchmarks/streaming_memory_benchmark.py [largest playlist size]
+#Analyses single-playlist libraries of growing size against fake_spotify.py and exits with status 1 if any of
+#them needs more than WORKING_MEMORY_BUDGET on top of its result
+import os
+import sys
+import gc
+import tracemalloc
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from analysis_benchmark import start_fake_spotify, load_app, reset_app, ignore_progress
+
+#Room for the queued pages, the rows waiting for an artist batch and one page per fetch thread, whatever the playlist size
+WORKING_MEMORY_BUDGET = 2 * 1024 * 1024
+
+def measure(pm, sp, fake_url, tracks):
+    #Returns (peak, retained) bytes of a full analysis of one playlist with this many tracks
+    reset_app(pm)
+    library = {'playlists': 1, 'tracks_per_playlist': tracks, 'overlap': 0}
+    requests.post(fake_url + "/_benchmark", json={'library': library}).raise_for_status()
+    gc.collect()
+    tracemalloc.start()
+    result = pm.analyse_genres(sp, progress=ignore_progress)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, retained
+
+if __name__ == "__main__":
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    sizes = sorted({1000, 10000, largest})
+    process, fake_url = start_fake_spotify()
+    try:
+        pm = load_app(fake_url, 100000)
+        with pm.app.test_request_context():
+            sp = pm.get_spotify({'access_token': "benchmark"})
+        print(f"{'tracks':>8} {'peak KiB':>10} {'result KiB':>11} {'working KiB':>12}")
+        over_budget = []
+        for tracks in sizes:
+            peak, retained = measure(pm, sp, fake_url, tracks)
+            print(f"{tracks:>8} {peak / 1024:>10.0f} {retained / 1024:>11.0f} {(peak - retained) / 1024:>12.0f}")
+            if peak - retained > WORKING_MEMORY_BUDGET:
+                over_budget.append(tracks)
+    finally:
+        process.terminate()
+
+    if over_budget:
+        print(f"Working memory above {WORKING_MEMORY_BUDGET // 1024} KiB for playlists of {over_budget} tracks")
+        sys.exit(1)
+    print(f"Working memory stayed within {WORKING_MEMORY_BUDGET // 1024} KiB for every playlist size")
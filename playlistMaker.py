@@ -1,33 +1,498 @@
 #Library importd and setup
 import os
 import spotipy
+import requests
 import time
+import json
+import sqlite3
+import threading
+import pickle
+import uuid
+import hashlib
+import logging
+import queue
+import zlib
 
 #Third-part imports
 from spotipy.oauth2 import SpotifyOAuth
-from flask import Flask, request, url_for, session, redirect, render_template_string
+from spotipy.cache_handler import CacheHandler
+from flask import Flask, request, url_for, session, redirect, render_template, jsonify, g, make_response
 from dotenv import load_dotenv
-from collections import Counter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import Counter, OrderedDict, deque
+from bisect import bisect_left
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from urllib.parse import urlsplit
 
 #Load environment variables from a .env file as to not expose sensitive information
 load_dotenv()
 
+#Leveled logging instead of prints, set LOG_LEVEL=DEBUG to see every analysis progress event
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("playlistMaker")
+
 #Initialising Flask application and setting secret key for sessionn security
 app = Flask(__name__)
 app.secret_key = os.getenv("secretKey")
 #Customise the session cookie name for clarity
 app.config["SESSION_COOKIE_NAME"] = "spotify-login-session"
+#Static files are versioned by content hash (see static_url), so browsers can keep them for a year
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365 * 24 * 3600
 
 #Constant for storing token info in session
 TOKEN_INFO = "token_info"
+#Tokens are refreshed in the background once they have less than this many seconds left, so requests don't wait for it
+TOKEN_REFRESH_AHEAD = int(os.getenv("TOKEN_REFRESH_AHEAD", "600"))
+#Session key caching the logged in user's ID and display name so routes don't need to call /me
+USER_INFO = "user_info"
+#Session key holding a small handle (user ID and version) to the user's analysis in the server-side cache
+ANALYSIS_HANDLE = "analysis"
+
+#Number of playlists fetched concurrently during analysis, raise it until Spotify's rate limit is the ceiling
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+#Only the fields the analysis reads are requested, instead of full album, image and market data for every track
+PLAYLIST_ITEM_FIELDS = "items(track(id,uri,artists(id))),next"
+#Largest page sizes the playlist endpoints allow
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+PLAYLISTS_PAGE_SIZE = 50
+#Spotify's multi-artist endpoint accepts at most 50 IDs per request
+ARTIST_BATCH_SIZE = 50
+#Fetched pages waiting to be applied during analysis, fetch threads pause while this many are queued
+ANALYSIS_QUEUED_PAGES = int(os.getenv("ANALYSIS_QUEUED_PAGES", str(FETCH_WORKERS * 2)))
+
+#On-disk SQLite cache shared by every worker process and user
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "spotify_cache.sqlite3")
+#Artist genres rarely change, so cached entries are kept for a week by default
+ARTIST_CACHE_TTL = int(os.getenv("ARTIST_CACHE_TTL", str(7 * 24 * 3600)))
+#Oldest artists are evicted once the cache holds more than this many entries
+ARTIST_CACHE_MAX_ENTRIES = int(os.getenv("ARTIST_CACHE_MAX_ENTRIES", "200000"))
+#Playlist contents are shared by every user following the playlist and only change with its snapshot ID, so fetched
+#pages are kept per (playlist, snapshot) for this long, for at most this many playlists
+PLAYLIST_CACHE_TTL = int(os.getenv("PLAYLIST_CACHE_TTL", str(30 * 24 * 3600)))
+PLAYLIST_CACHE_MAX_ENTRIES = int(os.getenv("PLAYLIST_CACHE_MAX_ENTRIES", "20000"))
+#SQLite connections can't be shared between threads, so each thread opens its own
+_cache_db_local = threading.local()
+
+#Set to a redis:// URL to share server-side caches between worker processes, otherwise each process keeps its own
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+#Memory budget for cached analyses per process, least recently used users are evicted first
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+#Analyses nobody has looked at for this long are dropped
+ANALYSIS_CACHE_MAX_IDLE = int(os.getenv("ANALYSIS_CACHE_MAX_IDLE", str(6 * 3600)))
+#Finished analyses are also saved as compressed snapshots in the cache database, so a restarted or evicting worker
+#loads them instead of analysing the library again. Bump the schema when the analysis result changes shape,
+#older snapshots are then ignored
+ANALYSIS_SNAPSHOT_SCHEMA = 2
+#Snapshots older than this are deleted
+ANALYSIS_SNAPSHOT_MAX_AGE = int(os.getenv("ANALYSIS_SNAPSHOT_MAX_AGE", str(30 * 24 * 3600)))
+#Genre search result pages are reused for this long, within their own memory budget
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+#Spotify returns at most 50 search results per request and none past offset 1000
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_OFFSET = 1000
+
+class MemoryCache:
+    #In-process LRU cache bounded by an approximate byte budget, entries expire after max_idle seconds unused
+    #and, when max_age is set, max_age seconds after they were stored
+    def __init__(self, max_bytes, max_idle, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.stats = Counter()
+        self._entries = OrderedDict() #key -> (value, size, last_used, stored_at), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            value, size, last_used, stored_at = entry
+            now = time.time()
+            if now - last_used > self.max_idle or (self.max_age and now - stored_at > self.max_age):
+                self._remove(key)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._entries[key] = (value, size, now, stored_at)
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+    
+    def set(self, key, value):
+        #Pickled size is used as a cheap, stable estimate of how much memory the value holds
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time(), time.time())
+            self._size += size
+            #Evict least recently used entries until back under budget, always keeping the newest one
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+    
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+    
+    def info(self):
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'bytes': self._size}
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._size -= entry[1]
+        return True
+
+class RedisCache:
+    #Cache shared by all worker processes, the byte budget and LRU eviction are set on the server (maxmemory-policy allkeys-lru)
+    def __init__(self, url, prefix, max_idle, max_age=None):
+        import redis #Only needed when CACHE_REDIS_URL is set
+        self.prefix = prefix
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.stats = Counter()
+        self._redis = redis.Redis.from_url(url)
+    
+    def get(self, key):
+        #GETEX refreshes the idle timeout on every read, entries with a fixed max_age keep their original expiry
+        if self.max_age:
+            data = self._redis.get(self.prefix + str(key))
+        else:
+            data = self._redis.getex(self.prefix + str(key), ex=self.max_idle)
+        if data is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return pickle.loads(data)
+    
+    def set(self, key, value):
+        self._redis.set(self.prefix + str(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=self.max_age or self.max_idle)
+    
+    def delete(self, key):
+        return bool(self._redis.delete(self.prefix + str(key)))
+    
+    def info(self):
+        server = self._redis.info('stats')
+        return {**self.stats, 'evictions': server.get('evicted_keys', 0), 'expired': server.get('expired_keys', 0)}
+
+def create_cache(prefix, max_bytes, max_idle, max_age=None):
+    #Picks the shared Redis backend when configured, otherwise an in-process cache
+    if CACHE_REDIS_URL:
+        return RedisCache(CACHE_REDIS_URL, prefix + ":", max_idle, max_age)
+    return MemoryCache(max_bytes, max_idle, max_age)
+
+#Spotify accepts at most 100 tracks per add-to-playlist request, a failed batch is retried this many times
+PLAYLIST_BATCH_SIZE = 100
+PLAYLIST_WRITE_RETRIES = int(os.getenv("PLAYLIST_WRITE_RETRIES", "3"))
+#Playlists filled at the same time when several are created in one go
+PLAYLIST_WRITE_WORKERS = int(os.getenv("PLAYLIST_WRITE_WORKERS", "4"))
+#Most genre playlists one request may create
+MAX_GENRE_PLAYLISTS = 50
+#Analyses run on this many background threads per process so requests never wait for them
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+#Finished jobs stay pollable for this many seconds
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "600"))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+jobs = {} #Job ID -> Job
+analysis_jobs = {} #User ID -> ID of that user's latest analysis job
+jobs_lock = threading.RLock()
+#A running analysis holds a lease on its user in the cache database so other worker processes wait for it instead of
+#analysing the same library. The lease is renewed while the analysis runs and lapses this many seconds after a crash
+ANALYSIS_LEASE_TTL = int(os.getenv("ANALYSIS_LEASE_TTL", "60"))
+#How often an analysis waiting for another worker's checks whether it has finished
+ANALYSIS_LEASE_POLL = float(os.getenv("ANALYSIS_LEASE_POLL", "1"))
+
+#Keep-alive connections kept open per host, enough for every fetch thread of every running analysis by default
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(FETCH_WORKERS * JOB_WORKERS)))
+#Retries for 429 and 5xx responses, 5xx ones back off exponentially and 429 ones wait for the rate limiter
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+#Longest Retry-After wait honoured inside a request before giving up and raising the 429
+HTTP_MAX_RETRY_AFTER = int(os.getenv("HTTP_MAX_RETRY_AFTER", "30"))
+#Spotify API requests per second allowed across all workers and users, and how many can be sent in a burst
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "10"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+#After a 429 the rate is halved (down to the minimum), then grows back by RATE_LIMIT_RECOVERY requests/second every second
+RATE_LIMIT_MIN_PER_SECOND = float(os.getenv("RATE_LIMIT_MIN_PER_SECOND", "1"))
+RATE_LIMIT_RECOVERY = float(os.getenv("RATE_LIMIT_RECOVERY", "0.2"))
+#Point these at a local stand-in server to run the app without the real Spotify API
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL")
+
+#Upper bounds (seconds) of the latency histogram buckets on /metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#Path segments that name a Spotify endpoint, any other segment is an ID and reported as {id} to keep label values few
+SPOTIFY_PATH_WORDS = {
+    'v1', 'me', 'users', 'playlists', 'tracks', 'items', 'artists', 'albums', 'search', 'top',
+    'following', 'followers', 'contains', 'images', 'related-artists', 'top-tracks', 'audio-features'
+}
+
+class Metrics:
+    #Counters and latency histograms for this process, rendered in the Prometheus text format on /metrics
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counters = Counter() #(name, labels) -> value
+        self._histograms = {} #(name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += amount
+    
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+    
+    def counters(self):
+        with self._lock:
+            return Counter(self._counters)
+    
+    @contextmanager
+    def span(self, name, **labels):
+        #Times a stage of the work, recorded as span_seconds{span=name} even when it raises
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('span_seconds', time.perf_counter() - start, span=name, **labels)
+    
+    def render(self, counters=None, gauges=None):
+        #counters and gauges add values kept elsewhere, like the caches' own hit counts, as {(name, labels): value}
+        all_counters = self.counters()
+        all_counters.update(counters or {})
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for kind, values in (('counter', all_counters), ('gauge', gauges or {})):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                    total += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {total}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+    
+    def _key(self, name, labels):
+        #Label values are kept as strings, so status=200 and status='error' sort together when rendered
+        return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    
+    def _labels(self, labels):
+        #{name="value",...} with backslashes, quotes and newlines in values escaped
+        if not labels:
+            return ""
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+def spotify_endpoint(url):
+    #/v1/playlists/37i9dQZF1DXcBWIGoYBM5M/tracks -> /v1/playlists/{id}/tracks
+    parts = urlsplit(url).path.split('/')
+    return '/'.join(part if not part or part in SPOTIFY_PATH_WORDS else '{id}' for part in parts)
+
+class RateLimiter:
+    #Token bucket kept in the shared cache database so every worker process and user draws from the same budget.
+    #The refill rate adapts: halved on every 429 and honouring its Retry-After, then slowly recovered
+    def __init__(self, max_rate, min_rate, burst, recovery):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.recovery = recovery
+        self.stats = Counter() #This process's requests, waits and throttle events
+        self._waiting = 0 #Requests in this process currently queued for a token
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        #Blocks until a request may be sent
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self._take_token()
+                if wait <= 0:
+                    break
+                with self._lock:
+                    self.stats['waits'] += 1
+                    self.stats['wait_seconds'] += wait
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self.stats['requests'] += 1
+    
+    def throttled(self, retry_after):
+        #Called when Spotify answers 429, pauses everyone for Retry-After seconds and halves the rate
+        now = time.time()
+        with self._lock:
+            self.stats['throttle_events'] += 1
+        try:
+            with cache_transaction() as conn:
+                rate, _, _, blocked_until, _ = self._read(conn, now)
+                conn.execute(
+                    "UPDATE rate_limit SET rate = ?, blocked_until = ?, throttle_events = throttle_events + 1 WHERE id = 1",
+                    (max(self.min_rate, rate / 2), max(blocked_until, now + retry_after))
+                )
+        except sqlite3.Error as e:
+            log.warning("Rate limiter unavailable: %s", e)
+            time.sleep(retry_after)
+    
+    def info(self):
+        try:
+            rate, tokens, _, blocked_until, throttle_events = self._read(cache_db(), time.time())
+        except sqlite3.Error:
+            rate, tokens, blocked_until, throttle_events = None, None, 0, None
+        with self._lock:
+            return {
+                **self.stats,
+                'rate': rate,
+                'tokens': tokens,
+                'blocked_for': max(0, round(blocked_until - time.time(), 1)),
+                'queue_depth': self._waiting,
+                'total_throttle_events': throttle_events
+            }
+    
+    def _take_token(self):
+        #Takes a token if one is available and returns 0, otherwise returns how long to wait before trying again
+        now = time.time()
+        try:
+            with cache_transaction() as conn:
+                rate, tokens, updated_at, blocked_until, _ = self._read(conn, now)
+                if now < blocked_until:
+                    wait = blocked_until - now
+                else:
+                    elapsed = max(0, now - updated_at)
+                    rate = min(self.max_rate, rate + self.recovery * elapsed)
+                    tokens = min(self.burst, tokens + rate * elapsed)
+                    wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                    if not wait:
+                        tokens -= 1
+                    conn.execute(
+                        "UPDATE rate_limit SET rate = ?, tokens = ?, updated_at = ? WHERE id = 1",
+                        (rate, tokens, now)
+                    )
+                return wait
+        except sqlite3.Error as e:
+            #Without the shared state requests go out unthrottled, 429s are still retried by the adapter
+            log.warning("Rate limiter unavailable: %s", e)
+            return 0
+    
+    def _read(self, conn, now):
+        row = conn.execute("SELECT rate, tokens, updated_at, blocked_until, throttle_events FROM rate_limit WHERE id = 1").fetchone()
+        if row is None:
+            row = (self.max_rate, self.burst, now, 0, 0)
+            conn.execute("INSERT OR IGNORE INTO rate_limit VALUES (1, ?, ?, ?, ?, ?)", row)
+        return row
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    #Sends every Spotify API request through the shared rate limiter and retries 429 responses after their Retry-After.
+    #Every attempt is counted and timed per endpoint (time spent waiting for the rate limiter excluded)
+    def send(self, request, **kwargs):
+        endpoint = spotify_endpoint(request.url)
+        for attempt in range(HTTP_RETRIES + 1):
+            rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = super().send(request, **kwargs)
+            except Exception:
+                metrics.inc('spotify_requests_total', endpoint=endpoint, method=request.method, status='error')
+                raise
+            metrics.observe('spotify_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+            metrics.inc('spotify_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+            if response.status_code != 429 or attempt == HTTP_RETRIES:
+                return response
+            retry_after = response.headers.get('Retry-After', '1')
+            rate_limiter.throttled(min(int(retry_after) if retry_after.isdigit() else 1, HTTP_MAX_RETRY_AFTER))
+            response.close()
+
+def create_http_session():
+    #Process-wide transport for all Spotify traffic: pooled keep-alive connections, 5xx retries with backoff
+    #and, for the Web API itself, the shared adaptive rate limiter
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False #429s are left to RateLimitedAdapter so every worker backs off together
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    api_adapter = RateLimitedAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    #Requests uses the adapter with the longest matching prefix, so only Web API calls are rate limited
+    session.mount(spotify_api_url(), api_adapter)
+    return session
+
+def spotify_api_url():
+    return (SPOTIFY_API_URL or "https://api.spotify.com/v1").rstrip('/') + '/'
+
+metrics = Metrics(METRICS_BUCKETS)
+rate_limiter = RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_MIN_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_RECOVERY)
+#One HTTP session per worker process, shared by every Spotify client and OAuth call so connections are kept alive and reused
+http_session = create_http_session()
 
-# Server-side cache to store genre data (since session cookies are too small, this helps avoid storing large data in session cookies)
-genre_data_cache = {}
+#Server-side cache to store genre data per user (since session cookies are too small, this helps avoid storing large data in session cookies)
+genre_data_cache = create_cache("genre_data", ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_MAX_IDLE)
+#Compact genre search result pages keyed by genre, market and offset
+search_cache = create_cache("search", SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL, SEARCH_CACHE_TTL)
+#Fetches the next search page while the user is still looking at the current one
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
+prefetching = set() #Search cache keys currently being prefetched
+prefetch_lock = threading.Lock()
+#Refreshes access tokens ahead of their expiry
+token_executor = ThreadPoolExecutor(max_workers=2)
+token_refreshes = {} #Refresh token -> Future of the refresh started with it, shared by every request still holding it
+token_refreshes_lock = threading.Lock()
+spotify_oauth = None #See get_spotify_oauth
+#Content hashes of static files, computed once per process for cache-busting URLs
+static_versions = {}
+#Hash of every template and static file, part of each page ETag so a deploy invalidates cached pages
+assets_version = None
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    #Per-route request counts and latency for /metrics
+    endpoint = request.endpoint or 'unknown'
+    metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    metrics.observe('http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
 
 @app.route("/")
 def login():
     #Generates Spotify OAuth URL and redirects user to Spotify's login page
-    auth_url = create_spotify_oauth().get_authorize_url()
+    auth_url = get_spotify_oauth().get_authorize_url()
     #Redirects the user to Spotify's authorization page to log in and authorize the app
     return redirect(auth_url)
 
@@ -38,9 +503,11 @@ def redirect_page():
     #Retrieves the temporary authorization code from the URL parameters
     code = request.args.get("code")
     #Exchanges the authorization code for an access token and refresh token
-    token_info = create_spotify_oauth().get_access_token(code, as_dict=True)
+    token_info = get_spotify_oauth().get_access_token(code, as_dict=True)
     #Stores the token info securely in the session
     session[TOKEN_INFO] = token_info
+    #Looks up the user once at login, later requests read it from the session
+    current_user(get_spotify(token_info))
     #Redirects the user to the dashboard page after successful login
     return redirect(url_for("dashboard", _external=True))
 
@@ -54,34 +521,26 @@ def dashboard():
             return token_info
         
         #Creating Spotipy client with the user access token
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify(token_info)
         
-        #Fetching the current users profile information
-        user = sp.me()
+        #The current users profile information, cached in the session since login
+        user = current_user(sp)
         username = user['display_name']
         user_id = user['id']
         
         #Retrieving cached genre data if available from the user to avoid repeated API calls 
-        genre_data = genre_data_cache.get(user_id)
+        genre_data = get_analysis(user_id)
         
-        #If no cached data, perform full genre analysis across the users playlist
-        if not genre_data:
-            print("\n" + "="*50)
-            print("Starting genre analysis...")
-            print("="*50)
-            genre_data = analyse_genres(sp)
-            
-            #If there is no genres being found would then print a message
-            if not genre_data['genres']:
-                print("No genres found!")
-
-            #Store the data in server cache, otherwise would have problems acessing the data as its too large for session cookies
-            genre_data_cache[user_id] = genre_data
-            #Purpose is to check terminal for progress
-            print("Analysis complete!")
-            print("Data cached for user")
-        else:
-            print("Using cached data for user")
+        #If no cached data, analyse the users playlists in the background (only changed playlists when refreshing)
+        #and show a progress page that reloads the dashboard once the analysis is done
+        if not genre_data or genre_data.get('stale'):
+            job = start_analysis_job(sp, user_id, genre_data)
+            if job.status == 'error':
+                #Forget the failed job so reloading the dashboard tries again
+                finish_analysis_job(user_id, job)
+                return render_error(f"Error analysing your playlists: {job.error}")
+            return render_progress(job.id, "Analysing your playlists...")
+        log.debug("Using cached analysis for user %s", user_id)
         
         #If no genres found, display a message prompting the user to add music
         if not genre_data['genres']:
@@ -89,256 +548,21 @@ def dashboard():
         
         #Extracting the top 10 genres for visualisation and display
         top_genres = genre_data['top_genres'][:10]
-        genre_labels = [g[0] for g in top_genres]
-        genre_counts = [g[1] for g in top_genres]
-        
-        #Stores the genre data in session for potential future use (routes)
-        session['genre_data'] = genre_data
-        
-        #HTML dashboard with embedded charts and sstatistics for the user to view 
-        html = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Your Music Statistics</title>
-            <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-            <style>
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    max-width: 1200px;
-                    margin: 0 auto;
-                    padding: 20px;
-                    background: linear-gradient(135deg, #1DB954 0%, #191414 100%);
-                    min-height: 100vh;
-                }}
-                .container {{
-                    background: white;
-                    border-radius: 15px;
-                    padding: 30px;
-                    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                }}
-                h1 {{
-                    color: #191414;
-                    text-align: center;
-                    margin-bottom: 10px;
-                }}
-                .subtitle {{
-                    text-align: center;
-                    color: #666;
-                    margin-bottom: 30px;
-                }}
-                .stats-box {{
-                    display: grid;
-                    grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                    gap: 20px;
-                    margin-bottom: 30px;
-                }}
-                .stat {{
-                    background: #f0f0f0;
-                    padding: 20px;
-                    border-radius: 10px;
-                    text-align: center;
-                }}
-                .stat-number {{
-                    font-size: 2em;
-                    font-weight: bold;
-                    color: #1DB954;
-                }}
-                .stat-label {{
-                    color: #666;
-                    margin-top: 5px;
-                }}
-                .charts {{
-                    display: grid;
-                    grid-template-columns: 1fr 1fr;
-                    gap: 30px;
-                    margin-bottom: 30px;
-                }}
-                .chart-container {{
-                    background: #f9f9f9;
-                    padding: 20px;
-                    border-radius: 10px;
-                }}
-                canvas {{
-                    max-height: 400px;
-                }}
-                .genre-list {{
-                    margin-top: 30px;
-                }}
-                .genre-item {{
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                    padding: 15px;
-                    margin: 10px 0;
-                    background: #f9f9f9;
-                    border-radius: 8px;
-                    transition: all 0.3s;
-                }}
-                .genre-item:hover {{
-                    background: #e8f5e9;
-                    transform: translateX(5px);
-                }}
-                .genre-name {{
-                    font-weight: bold;
-                    color: #333;
-                }}
-                .genre-count {{
-                    color: #666;
-                }}
-                .button {{
-                    display: inline-block;
-                    padding: 12px 24px;
-                    background: #1DB954;
-                    color: white;
-                    text-decoration: none;
-                    border-radius: 25px;
-                    font-weight: bold;
-                    transition: all 0.3s;
-                    border: none;
-                    cursor: pointer;
-                    font-size: 14px;
-                }}
-                .button:hover {{
-                    background: #1ed760;
-                    transform: translateY(-2px);
-                    box-shadow: 0 5px 15px rgba(29, 185, 84, 0.3);
-                }}
-                .button-secondary {{
-                    background: #535353;
-                }}
-                .button-secondary:hover {{
-                    background: #404040;
-                }}
-                .actions {{
-                    text-align: center;
-                    margin-top: 30px;
-                }}
-                @media (max-width: 768px) {{
-                    .charts {{
-                        grid-template-columns: 1fr;
-                    }}
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Your Music Statistics</h1>
-                <p class="subtitle">Welcome, {username}!</p>
-                
-                <div class="stats-box">
-                    <div class="stat">
-                        <div class="stat-number">{genre_data['total_tracks']}</div>
-                        <div class="stat-label">Total Tracks</div>
-                    </div>
-                    <div class="stat">
-                        <div class="stat-number">{genre_data['total_playlists']}</div>
-                        <div class="stat-label">Playlists</div>
-                    </div>
-                    <div class="stat">
-                        <div class="stat-number">{len(genre_data['genres'])}</div>
-                        <div class="stat-label">Unique Genres</div>
-                    </div>
-                    <div class="stat">
-                        <div class="stat-number">{genre_data['total_artists']}</div>
-                        <div class="stat-label">Unique Artists</div>
-                    </div>
-                </div>
-                
-                <div class="charts">
-                    <div class="chart-container">
-                        <h3>Top Genres (Bar Chart)</h3>
-                        <canvas id="barChart"></canvas>
-                    </div>
-                    <div class="chart-container">
-                        <h3>Genre Distribution (Pie Chart)</h3>
-                        <canvas id="pieChart"></canvas>
-                    </div>
-                </div>
-                
-                <div class="genre-list">
-                    <h3>Your Top Genres</h3>
-                    {''.join([f'''
-                    <div class="genre-item">
-                        <span class="genre-name">{i+1}. {genre}</span>
-                        <div>
-                            <span class="genre-count">{count} tracks</span>
-                            <a href="/create-genre-playlist?genre={genre.replace(' ', '+')}" class="button" style="margin-left: 15px;">Create Playlist</a>
-                        </div>
-                    </div>
-                    ''' for i, (genre, count) in enumerate(top_genres)])}
-                </div>
-                
-                <div class="actions">
-                    <a href="/custom-genre" class="button button-secondary">Search Custom Genre</a>
-                    <a href="/refresh-analysis" class="button button-secondary">Refresh Analysis</a>
-                </div>
-            </div>
-            
-            <script>
-                const genres = {genre_labels};
-                const counts = {genre_counts};
-                
-                // Generate colors
-                const colors = [
-                    '#1DB954', '#1ed760', '#169c46', '#117a37',
-                    '#0d5c2a', '#535353', '#b3b3b3', '#ffffff',
-                    '#ff6b6b', '#4ecdc4'
-                ];
-                
-                // Bar Chart
-                new Chart(document.getElementById('barChart'), {{
-                    type: 'bar',
-                    data: {{
-                        labels: genres,
-                        datasets: [{{
-                            label: 'Number of Tracks',
-                            data: counts,
-                            backgroundColor: colors,
-                            borderWidth: 0
-                        }}]
-                    }},
-                    options: {{
-                        responsive: true,
-                        maintainAspectRatio: true,
-                        plugins: {{
-                            legend: {{ display: false }}
-                        }},
-                        scales: {{
-                            y: {{
-                                beginAtZero: true,
-                                ticks: {{ precision: 0 }}
-                            }}
-                        }}
-                    }}
-                }});
-                
-                // Pie Chart
-                new Chart(document.getElementById('pieChart'), {{
-                    type: 'pie',
-                    data: {{
-                        labels: genres,
-                        datasets: [{{
-                            data: counts,
-                            backgroundColor: colors
-                        }}]
-                    }},
-                    options: {{
-                        responsive: true,
-                        maintainAspectRatio: true,
-                        plugins: {{
-                            legend: {{
-                                position: 'bottom'
-                            }}
-                        }}
-                    }}
-                }});
-            </script>
-        </body>
-        </html>
-        '''
-        
-        return html
+        #Only a handle to the analysis goes in the session cookie, routes load the data itself with load_genre_data().
+        #Written only when it changed, so unchanged dashboards (and their 304s) don't re-sign the cookie
+        handle = {'id': user_id, 'version': genre_data['version']}
+        if session.get(ANALYSIS_HANDLE) != handle:
+            session[ANALYSIS_HANDLE] = handle
+        
+        #Unchanged analysis, the browser's copy of the page is still current so nothing is rendered
+        etag = etag_for('dashboard', user_id, username, genre_data['version'])
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        #Dashboard template, the charts load their data from /api/genre-data
+        page = render_page("dashboard.html", username=username, genre_data=genre_data, top_genres=top_genres)
+        return conditional(page, etag)
     
     except spotipy.exceptions.SpotifyException as e:
         #Handles Spotify API errors
@@ -347,6 +571,64 @@ def dashboard():
         #Handles unexpected errors
         return render_error(f"Error: {str(e)}")
 
+@app.route("/api/genre-data")
+def genre_chart_data():
+    #Top 10 genres and their track counts for the dashboard charts
+    genre_data = load_genre_data()
+    if not genre_data:
+        return jsonify({'error': 'No analysis available'}), 404
+    etag = etag_for('genre-data', genre_data['version'])
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    top_genres = genre_data['top_genres'][:10]
+    return conditional(jsonify({
+        'labels': [genre for genre, _ in top_genres],
+        'counts': [count for _, count in top_genres],
+    }), etag)
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    #JSON progress of a background job, polled by the progress page
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    #ETag from everything but the elapsed time, so polls between progress updates get an empty 304
+    job_info = job.to_dict()
+    unchanged = {name: value for name, value in job_info.items() if name != 'elapsed'}
+    response = jsonify(job_info)
+    response.set_etag(etag_for('job', json.dumps(unchanged, sort_keys=True, default=str)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route("/metrics")
+def metrics_page():
+    #Prometheus scrape endpoint, each worker process reports its own numbers
+    counters = Counter()
+    gauges = {}
+    #The server-side caches count their own hits, the artist genre cache reports straight to metrics
+    for name, cache in (('analysis', genre_data_cache), ('search', search_cache)):
+        for stat in ('hits', 'misses', 'evictions', 'expired'):
+            counters[(f'cache_{stat}_total', (('cache', name),))] = cache.stats[stat]
+    all_counters = metrics.counters()
+    all_counters.update(counters)
+    for (name, labels), hits in list(all_counters.items()):
+        if name == 'cache_hits_total':
+            lookups = hits + all_counters[('cache_misses_total', labels)]
+            gauges[('cache_hit_ratio', labels)] = round(hits / lookups, 4) if lookups else 0
+    limiter = rate_limiter.info()
+    for stat in ('requests', 'waits', 'wait_seconds', 'throttle_events'):
+        counters[(f'rate_limiter_{stat}_total', ())] = limiter.get(stat, 0)
+    for stat in ('rate', 'tokens', 'queue_depth'):
+        if limiter[stat] is not None:
+            gauges[(f'rate_limiter_{stat}', ())] = limiter[stat]
+    return metrics.render(counters, gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route("/rate-limit-status")
+def rate_limit_status():
+    #Current shared request rate, queued requests in this process and 429 throttle events
+    return jsonify(rate_limiter.info())
+
 @app.route("/analyse")
 def analyse():
     try:
@@ -355,13 +637,12 @@ def analyse():
         if not isinstance(token_info, dict):
             return token_info #Redirects to login if token is invalid
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        user_id = sp.me()['id'] #Fetches the user's Spotify ID
+        sp = get_spotify(token_info)
+        user_id = current_user(sp)['id'] #The user's Spotify ID
         
-        #Remove cached genre data so next dashboard load will re-analyse
-        if user_id in genre_data_cache:
-            del genre_data_cache[user_id]
-            #print(f"Cleared cache for user: {user_id}") #Debugging purpose
+        #Mark cached genre data as stale so next dashboard load will re-analyse the changed playlists
+        if mark_analysis_stale(user_id):
+            log.info("Marked analysis stale for user %s", user_id)
         
         return redirect(url_for("dashboard")) #Trigger dashboard reload
     except:
@@ -376,13 +657,12 @@ def refresh_analysis():
         if not isinstance(token_info, dict):
             return token_info
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        user_id = sp.me()['id']
+        sp = get_spotify(token_info)
+        user_id = current_user(sp)['id']
         
-        #Remove cached genre data so next dashboard load will re-analyse
-        if user_id in genre_data_cache:
-            del genre_data_cache[user_id]
-            print(f"Cleared cache for user: {user_id}")
+        #Mark cached genre data as stale so next dashboard load will re-analyse the changed playlists
+        if mark_analysis_stale(user_id):
+            log.info("Marked analysis stale for user %s", user_id)
         
         return redirect(url_for("dashboard"))
     except:
@@ -401,95 +681,96 @@ def create_genre_playlist():
         if not isinstance(token_info, dict):
             return token_info
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        user_id = sp.me()['id']
+        sp = get_spotify(token_info)
+        user_id = current_user(sp)['id']
         
         #Retrives cached analysis data
-        genre_data = genre_data_cache.get(user_id)
+        genre_data = get_analysis(user_id)
         
         if not genre_data:
-            print(f"No cached data for user {user_id}, redirecting to dashboard")
+            log.info("No cached analysis for user %s, redirecting to dashboard", user_id)
             return redirect(url_for("dashboard"))
         
-        print(f"\n{'='*50}")
-        print(f"Creating playlist for genre: '{genre}'")
-        print(f"User: {user_id}")
-        print(f"{'='*50}")
-        
-        #Filter tracks matching the specified genre
-        track_uris = []
-        #Progess checker in terminal
-        print(f"Searching through {len(genre_data['track_genres'])}")
-        
-        for track_genre, uri in genre_data['track_genres']:
-            #Check if the genre matches
-            if genre == track_genre.lower() or genre in track_genre.lower():
-                track_uris.append(uri)
+        log.info("Creating playlist for genre '%s' for user %s", genre, user_id)
         
-        #Removing duplicates
-        track_uris = list(set(track_uris))
-        #Print the matching tracks found in terminal 
-        print(f"Found {len(track_uris)} matching tracks")
+        #Look up tracks whose genre matches or contains the requested one, exact matches first
+        genre_index = genre_data['genre_index']
+        track_uris = genre_index.lookup(genre)
+        log.info("Found %d tracks matching genre '%s'", len(track_uris), genre)
         
         if not track_uris:
-            print(f"No tracks found for genre '{genre}'")
             #Show available genres for debugging
-            all_genres = set([g for g, _ in genre_data['track_genres']])
-            print(f"Available genres: {sorted(all_genres)}")
+            log.debug("Available genres: %s", sorted(genre_index.tracks_by_genre))
             return render_error(f"No tracks found for genre '{genre}'. Try another genre from the list.")
         
         #Create playlist
-        user_id = sp.me()['id']
-        playlist_name = f"{genre.title()} - My Collection"
+        playlist_name = genre_playlist_name(genre)
         
-        print(f"Creating playlist '{playlist_name}'...")
-        
-        new_playlist = sp.user_playlist_create(
-            user_id, 
-            playlist_name, 
-            public=False, 
-            description=f"Curated {genre} playlist created by Genre Analyser"
-        )
-        
-        print(f"Playlist created with ID: {new_playlist['id']}")
-        
-        #Add tracks in batches of 100 for Spotify API limits
-        added_count = 0
-        for i in range(0, len(track_uris), 100):
-            batch = track_uris[i:i+100]
-            sp.user_playlist_add_tracks(user_id, new_playlist['id'], batch)
-            added_count += len(batch)
-            print(f"Added batch: {added_count}/{len(track_uris)} tracks")
+        new_playlist = create_genre_playlist_for(sp, user_id, genre)
         
+        #Tracks are added in the background, the success page shows how far the upload has got
+        job = start_playlist_write(sp, new_playlist['id'], track_uris)
         playlist_url = new_playlist['external_urls']['spotify']
         
-        print(f"Playlist created successfully!")
-        print(f"URL: {playlist_url}")
-        print(f"{'='*50}\n")
+        log.info("Created playlist '%s' (%s), adding tracks on job %s", playlist_name, playlist_url, job.id)
         
         return render_success(
             f"Created playlist '{playlist_name}' with {len(track_uris)} tracks!",
-            playlist_url
+            playlist_url,
+            job.id
         )
         
     except spotipy.exceptions.SpotifyException as e:
-        print(f"Spotify API Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Spotify API error creating playlist for genre '%s'", genre)
         return render_error(f"Spotify API Error: {str(e)}. Check the terminal for details.")
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error creating playlist for genre '%s'", genre)
         return render_error(f"Error creating playlist: {str(e)}. Check the terminal for details.")
 
+@app.route("/create-genre-playlists")
+def create_genre_playlists():
+    #Creates one playlist per genre, for the genres given as ?genres=a,b or the ?top=N genres on the dashboard
+    try:
+        token_info = get_token()
+        if not isinstance(token_info, dict):
+            return token_info
+        
+        sp = get_spotify(token_info)
+        user_id = current_user(sp)['id']
+        
+        genre_data = get_analysis(user_id)
+        if not genre_data:
+            return redirect(url_for("dashboard"))
+        
+        if request.args.get("genres"):
+            genres = [genre.lower().strip() for genre in request.args["genres"].split(",") if genre.strip()]
+            genres = list(dict.fromkeys(genres))[:MAX_GENRE_PLAYLISTS]
+        else:
+            top = max(1, min(int(request.args.get("top", 10)), MAX_GENRE_PLAYLISTS))
+            genres = [genre.lower() for genre, _ in genre_data['top_genres'][:top]]
+        
+        #All track lists come from the prebuilt index in one go, genres without tracks are skipped
+        genre_index = genre_data['genre_index']
+        genre_tracks = [(genre, genre_index.lookup(genre)) for genre in dict.fromkeys(genres)]
+        genre_tracks = [(genre, track_uris) for genre, track_uris in genre_tracks if track_uris]
+        if not genre_tracks:
+            return render_error("None of those genres have tracks in your library.")
+        
+        #Playlists are created and filled together on one background job
+        job = start_job('playlist_write', write_genre_playlists, sp, user_id, genre_tracks)
+        total_tracks = sum(len(track_uris) for _, track_uris in genre_tracks)
+        return render_success(f"Creating {len(genre_tracks)} genre playlists with {total_tracks} tracks in total!", None, job.id)
+    
+    except Exception as e:
+        return render_error(f"Error creating playlists: {str(e)}")
+
 @app.route("/search-new-songs")
 def search_new_songs():
     genre = request.args.get("genre", "")
     
     if not genre:
-        #No genre provided, show selection interface using cached session data
-        genre_data = session.get('genre_data', {})
+        #No genre provided, show selection interface using the cached analysis
+        genre_data = load_genre_data() or {}
         top_genres = genre_data.get('top_genres', [])[:10]
     
     #Search for songs
@@ -498,137 +779,49 @@ def search_new_songs():
         if not isinstance(token_info, dict):
             return token_info
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify(token_info)
+        market = request.args.get("market") or None
         
-        #Search for tracks in this genre
-        results = sp.search(q=f'genre:"{genre}"', type='track', limit=50)
-        tracks = results['tracks']['items']
+        #Search for tracks in this genre, repeated searches are served from the cache
+        page = search_genre_tracks(sp, genre, market, 0)
+        tracks = page['tracks']
         
         if not tracks:
             return render_error(f"No tracks found for genre '{genre}'")
+        #Start loading the next page so "Load more" is instant
+        prefetch_search_page(sp, genre, market, page['next_offset'])
         
-        #Creating the HTML for track selection
-        track_html = ''.join([f'''
-        <div class="track-item">
-            <input type="checkbox" name="tracks" value="{track['uri']}" id="track{i}">
-            <label for="track{i}">
-                <strong>{track['name']}</strong><br>
-                <small>{', '.join([artist['name'] for artist in track['artists']])}</small>
-            </label>
-        </div>
-        ''' for i, track in enumerate(tracks)])
-        
-        html = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>New {genre.title()} Songs</title>
-            <style>
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    max-width: 900px;
-                    margin: 20px auto;
-                    padding: 20px;
-                    background: linear-gradient(135deg, #1DB954 0%, #191414 100%);
-                    min-height: 100vh;
-                }}
-                .container {{
-                    background: white;
-                    border-radius: 15px;
-                    padding: 30px;
-                    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                }}
-                h1 {{ color: #191414; }}
-                .track-item {{
-                    padding: 15px;
-                    margin: 10px 0;
-                    background: #f9f9f9;
-                    border-radius: 8px;
-                    display: flex;
-                    align-items: center;
-                    gap: 15px;
-                }}
-                .track-item:hover {{
-                    background: #e8f5e9;
-                }}
-                input[type="checkbox"] {{
-                    width: 20px;
-                    height: 20px;
-                    cursor: pointer;
-                }}
-                label {{
-                    cursor: pointer;
-                    flex: 1;
-                }}
-                .button {{
-                    padding: 15px 30px;
-                    background: #1DB954;
-                    color: white;
-                    border: none;
-                    border-radius: 25px;
-                    font-size: 16px;
-                    font-weight: bold;
-                    cursor: pointer;
-                    margin: 10px 5px;
-                }}
-                .button:hover {{
-                    background: #1ed760;
-                }}
-                .button-secondary {{
-                    background: #535353;
-                }}
-                .button-secondary:hover {{
-                    background: #404040;
-                }}
-                .actions {{
-                    position: sticky;
-                    bottom: 0;
-                    background: white;
-                    padding: 20px;
-                    margin: 20px -30px -30px -30px;
-                    border-radius: 0 0 15px 15px;
-                    box-shadow: 0 -5px 15px rgba(0,0,0,0.1);
-                    text-align: center;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>New {genre.title()} Songs</h1>
-                <p style="color: #666;">Found {len(tracks)} tracks. Select the ones you want to add to a new playlist:</p>
-                
-                <form method="POST" action="/add-to-playlist">
-                    <input type="hidden" name="genre" value="{genre}">
-                    <button type="button" onclick="selectAll()" class="button button-secondary">Select All</button>
-                    <button type="button" onclick="deselectAll()" class="button button-secondary">Deselect All</button>
-                    
-                    <div style="margin: 20px 0;">
-                        {track_html}
-                    </div>
-                    
-                    <div class="actions">
-                        <button type="submit" class="button">Create Playlist with Selected</button>
-                        <a href="/search-new-songs" class="button button-secondary">← Back</a>
-                    </div>
-                </form>
-            </div>
-            
-            <script>
-                function selectAll() {{
-                    document.querySelectorAll('input[type="checkbox"]').forEach(cb => cb.checked = true);
-                }}
-                function deselectAll() {{
-                    document.querySelectorAll('input[type="checkbox"]').forEach(cb => cb.checked = false);
-                }}
-            </script>
-        </body>
-        </html>
-        '''
-        return html
-        
+        return render_page("search.html", genre=genre, market=market, page=page)
+    
     except Exception as e:
         return render_error(f"Error searching songs: {str(e)}")
 
+@app.route("/search-new-songs/page")
+def search_new_songs_page():
+    #JSON page of genre search results for "Load more", prefetches the page after it
+    genre = request.args.get("genre", "")
+    if not genre:
+        return jsonify({'error': 'No genre specified'}), 400
+    try:
+        offset = int(request.args.get("offset") or 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid offset'}), 400
+    #Only offsets of whole pages Spotify will serve, so any offset maps onto one of the cached pages
+    offset = max(0, min(offset, SEARCH_MAX_OFFSET - SEARCH_PAGE_SIZE)) // SEARCH_PAGE_SIZE * SEARCH_PAGE_SIZE
+    try:
+        token_info = get_token()
+        if not isinstance(token_info, dict):
+            return jsonify({'error': 'Not logged in'}), 401
+        
+        sp = get_spotify(token_info)
+        market = request.args.get("market") or None
+        page = search_genre_tracks(sp, genre, market, offset)
+        prefetch_search_page(sp, genre, market, page['next_offset'])
+        return jsonify(page)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route("/add-to-playlist", methods=["POST"])
 def add_to_playlist():
     try:
@@ -636,7 +829,7 @@ def add_to_playlist():
         if not isinstance(token_info, dict):
             return token_info
         
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify(token_info)
         
         genre = request.form.get('genre', 'Music')
         track_uris = request.form.getlist('tracks')
@@ -645,20 +838,18 @@ def add_to_playlist():
             return render_error("No tracks selected!")
         
         #Creating playlist
-        user_id = sp.me()['id']
+        user_id = current_user(sp)['id']
         playlist_name = f"Discover {genre.title()} - {time.strftime('%Y-%m-%d')}"
         new_playlist = sp.user_playlist_create(user_id, playlist_name, public=False)
         
-        #Adding tracks
-        for i in range(0, len(track_uris), 100):
-            batch = track_uris[i:i+100]
-            sp.user_playlist_add_tracks(user_id, new_playlist['id'], batch)
-        
+        #Adding tracks in the background
+        job = start_playlist_write(sp, new_playlist['id'], track_uris)
         playlist_url = new_playlist['external_urls']['spotify']
         
         return render_success(
             f"Created playlist '{playlist_name}' with {len(track_uris)} tracks!",
-            playlist_url
+            playlist_url,
+            job.id
         )
         
     except Exception as e:
@@ -669,265 +860,1070 @@ def custom_genre():
     genre = request.args.get("genre", "")
     
     if not genre:
-        html = '''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Custom Genre Search</title>
-            <style>
-                body {
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    max-width: 600px;
-                    margin: 100px auto;
-                    padding: 20px;
-                    background: linear-gradient(135deg, #1DB954 0%, #191414 100%);
-                    min-height: 100vh;
-                }
-                .container {
-                    background: white;
-                    border-radius: 15px;
-                    padding: 40px;
-                    box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                }
-                h1 { color: #191414; text-align: center; }
-                input[type="text"] {
-                    width: 100%;
-                    padding: 15px;
-                    font-size: 16px;
-                    border: 2px solid #e0e0e0;
-                    border-radius: 10px;
-                    margin: 20px 0;
-                    box-sizing: border-box;
-                }
-                input[type="text"]:focus {
-                    outline: none;
-                    border-color: #1DB954;
-                }
-                .button {
-                    width: 100%;
-                    padding: 15px;
-                    background: #1DB954;
-                    color: white;
-                    border: none;
-                    border-radius: 25px;
-                    font-size: 16px;
-                    font-weight: bold;
-                    cursor: pointer;
-                }
-                .button:hover {
-                    background: #1ed760;
-                }
-                .back-link {
-                    display: block;
-                    text-align: center;
-                    margin-top: 20px;
-                    color: #666;
-                    text-decoration: none;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Search Custom Genre</h1>
-                <form method="get">
-                    <input type="text" name="genre" placeholder="Enter genre" required>
-                    <button type="submit" class="button">Search in My Library</button>
-                </form>
-                <a href="/dashboard" class="back-link">← Back to Dashboard</a>
-            </div>
-        </body>
-        </html>
-        '''
-        return html
+        return render_page("custom_genre.html")
     
     # Search in user's library
     return redirect(url_for("create_genre_playlist", genre=genre))
 
-def analyse_genres(sp):
-    print("Fetching playlists")
-    #Retrieves all the playlists from the user library (handling pagination)
-    playlists = []
-    results = sp.current_user_playlists()
-    playlists.extend(results['items'])
-    while results['next']:
-        results = sp.next(results)
-        playlists.extend(results['items'])
-    
-    print(f"Found {len(playlists)} playlists")
-    
-    #Initialise counters and caches
-    genre_counter = Counter() #Tracks the genre counts
-    track_genres = []  #Stores (genre, track_uri) pairs for playlist creation
-    artist_cache = {} #Cache artist genre data to reduce API calls
-    seen_tracks = set() #Prevents duplicate track processing
-    total_tracks = 0
-    unique_artists = set() #Track unique artist ID
-    
-    #Iterate through each playlist to fetch tracks and their genres
-    for idx, playlist in enumerate(playlists):
-        #Checking in terminal for progess of it checking each playlist
-        print(f"Processing playlist {idx+1}/{len(playlists)}: {playlist['name']}")
-        try:
-            #Fetch all tracks in the playlist (handling pagination)
-            results = sp.playlist_items(playlist['id'])
-            tracks = results['items']
-            while results['next']:
-                results = sp.next(results)
-                tracks.extend(results['items'])
-            print(f"  - Found {len(tracks)} tracks in this playlist")
-            
-            #Process each track to get artist and genre information
-            for item in tracks:
-                track = item.get('track')
-                if not track or not track.get('id') or track['id'] in seen_tracks:
-                    continue #Skipping invalid or duplicate tracks
-                seen_tracks.add(track['id'])
-                total_tracks += 1
-                
-                if not track.get('artists') or not track['artists'][0].get('id'):
-                    continue #Skipping tracks without artist information
-                
-                artist_id = track['artists'][0]['id']
-                unique_artists.add(artist_id)
-                
-                #Use cached genres if available, otherwise fetch from Spotify
-                if artist_id in artist_cache:
-                    artist_genres = artist_cache[artist_id]
-                else:
-                    try:
-                        artist = sp.artist(artist_id)
-                        artist_genres = artist.get('genres', [])
-                        artist_cache[artist_id] = artist_genres
-                        
-                        if artist_genres:
-                            print(f"Found genres for {track['artists'][0]['name']}: {artist_genres}")
-                        
-                        time.sleep(0.1)  #Respect rate limits
-                    except Exception as e:
-                        print(f"Error fetching artist {artist_id}: {e}")
+def analyse_genres(sp, previous=None, progress=None):
+    #Streams the library through a pipeline of playlist pages -> track rows -> artist resolution -> aggregation, so each
+    #page is dropped as soon as its rows are stored and the memory used on top of the result doesn't grow with playlist size.
+    #When previous (an earlier result for the same user) is given, only playlists whose snapshot_id changed are downloaded again.
+    #progress is called with structured events (name plus fields) as the analysis advances, logged by default
+    progress = progress or log_progress
+    #Retrieves all the playlists from the user library (handling pagination) as (id, name, snapshot_id)
+    with metrics.span('list_playlists'):
+        playlists = list(iter_playlists(sp))
+    
+    #Start from the previous per-playlist contributions so unchanged playlists cost no API calls
+    state = previous['state'].copy() if previous and previous.get('state') else LibraryState()
+    changed = [playlist for playlist in playlists if state.snapshot_of(playlist[0]) != playlist[2]]
+    progress('playlists_listed', playlists=len(playlists), changed=len(changed))
+    
+    #Playlists that were deleted or unfollowed no longer contribute
+    current_ids = {playlist_id for playlist_id, _, _ in playlists}
+    for playlist_id in list(state.playlists):
+        if playlist_id not in current_ids:
+            state.remove_playlist(playlist_id)
+    
+    #Artists whose lookup failed last time, or every artist once their genres are older than the artist cache keeps
+    #them, are looked up again so their tracks in unchanged playlists pick up the genres
+    if time.time() - state.artists_checked_at > ARTIST_CACHE_TTL:
+        state.artists_checked_at = time.time()
+        recheck_artists = list(state.artist_refs)
+    else:
+        state.unresolved_artists &= state.artist_refs.keys()
+        recheck_artists = list(state.unresolved_artists)
+    if recheck_artists:
+        with metrics.span('resolve_artists'):
+            recheck_artist_genres(sp, state, recheck_artists)
+    
+    #Download the changed playlists and apply them to the counters page by page
+    with metrics.span('fetch_playlists'):
+        stream_playlists(sp, changed, state, progress)
+    genre_counter = state.genre_counter
+    
+    with metrics.span('aggregate'):
+        #Map tracks to genres, each track counted once in the first playlist containing it
+        track_genres = TrackGenreTable()  #Stores (genre, track_uri) pairs for playlist creation
+        #Prevents duplicate track processing, only tracks with more than one playlist entry need remembering
+        seen_tracks = set()
+        for playlist_id, _, _ in playlists:
+            _, rows = state.playlists.get(playlist_id, (None, []))
+            for track_id, uri, artist_id in rows:
+                if state.track_refs[track_id] > 1:
+                    if track_id in seen_tracks:
                         continue
-                
-                #Count genres and map tracs to genres
+                    seen_tracks.add(track_id)
+                artist_genres = state.artist_genres.get(artist_id)
                 if artist_genres:
-                    for genre in artist_genres:
-                        genre_counter[genre] += 1
-                        track_genres.append((genre, track['uri']))
-                    
-        except Exception as e:
-            print(f"Error processing playlist {playlist['name']}: {e}")
-            continue
+                    track_genres.add_track(uri, artist_genres)
+        del seen_tracks
+        genre_index = GenreIndex(track_genres)
+    
+    #Most common first, ties by name so equal counts don't depend on the order pages arrived in
+    top_genres = sorted(genre_counter.items(), key=lambda item: (-item[1], item[0]))
         
-    #Final summary of the analysis in terminal to check the progess and results
-    print(f"\n=== Analysis Complete ===")
-    print(f"Total tracks processed: {total_tracks}")
-    print(f"Unique artists: {len(unique_artists)}")
-    print(f"Genres found: {len(genre_counter)}")
-    print(f"Top 5 genres: {genre_counter.most_common(5)}")
+    #Final summary of the analysis to check the progess and results
+    progress(
+        'analysis_complete',
+        tracks=len(state.track_refs),
+        artists=len(state.artist_refs),
+        genres=len(genre_counter),
+        top_genres=top_genres[:5]
+    )
     
     return {
         'genres': dict(genre_counter),
-        'top_genres': genre_counter.most_common(),
+        'top_genres': top_genres,
         'track_genres': track_genres,
-        'total_tracks': total_tracks,
+        'genre_index': genre_index,
+        'total_tracks': len(state.track_refs),
         'total_playlists': len(playlists),
-        'total_artists': len(unique_artists)
+        'total_artists': len(state.artist_refs),
+        'state': state, #Kept so the next refresh can be incremental
+        'version': analysis_version(top_genres, state, playlists)
+    }
+
+def analysis_version(top_genres, state, playlists):
+    #Hash of everything the dashboard shows, a refresh that changes nothing keeps the same version (and ETag)
+    summary = (top_genres, len(state.track_refs), len(playlists), len(state.artist_refs))
+    return hashlib.sha1(repr(summary).encode()).hexdigest()[:12]
+
+def stream_playlists(sp, playlists, state, progress):
+    #Fetch threads download the playlists a page at a time into a bounded queue, this thread stores each page's rows
+    #in the state and counts them once their artists are resolved. A playlist that can't be fetched keeps its previous contribution
+    pages = queue.Queue(maxsize=ANALYSIS_QUEUED_PAGES)
+    stop = threading.Event()
+    
+    def send(item):
+        #Waits for room in the queue, unless the analysis has stopped
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def fetch(index, playlist_id, snapshot_id):
+        #Runs on a fetch thread: (index, rows) per page, then (index, None) when done or (index, exception) if it failed
+        try:
+            for rows in iter_playlist_rows(sp, playlist_id, snapshot_id):
+                if stop.is_set():
+                    return
+                send((index, rows))
+            send((index, None))
+        except Exception as e:
+            send((index, e))
+    
+    resolver = ArtistResolver(sp, state, progress)
+    previous_entries = {playlist_id: state.playlists.get(playlist_id) for playlist_id, _, _ in playlists}
+    remaining = len(playlists)
+    done = 0
+    fetched_tracks = 0
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        try:
+            for index, (playlist_id, _, snapshot_id) in enumerate(playlists):
+                state.start_playlist(playlist_id, snapshot_id)
+                executor.submit(fetch, index, playlist_id, snapshot_id)
+            while remaining:
+                index, rows = pages.get()
+                playlist_id, name, _ = playlists[index]
+                if isinstance(rows, list):
+                    state.append_rows(playlist_id, rows)
+                    resolver.count_rows(rows)
+                    fetched_tracks += len(rows)
+                    continue
+                remaining -= 1
+                if rows is None:
+                    done += 1
+                    progress('playlist_processed', done=done, total=len(playlists), name=name, tracks=fetched_tracks)
+                    continue
+                #Playlist could not be fetched, any previous contribution is kept
+                log.warning("Error processing playlist %s: %s", name, rows)
+                resolver.flush() #Every stored row has to be counted before the playlist can be removed
+                state.remove_playlist(playlist_id)
+                if previous_entries[playlist_id]:
+                    state.set_playlist(playlist_id, *previous_entries[playlist_id])
+                progress('playlist_failed', name=name)
+            resolver.flush()
+        finally:
+            stop.set()
+    evict_playlist_contents()
+
+class ArtistResolver:
+    #Counts streamed track rows in the state's genre counters. Rows whose artist's genres aren't known yet wait here,
+    #new artists are looked up in the on-disk cache as they appear and the rest are fetched in full batches of
+    #ARTIST_BATCH_SIZE, so streaming makes no more artist requests than resolving every artist at the end
+    def __init__(self, sp, state, progress):
+        self.sp = sp
+        self.state = state
+        self.progress = progress
+        self.waiting = {} #Artist ID -> rows waiting for that artist's genres, in the order the artists were found
+        self.found = 0 #Artists that need an API request
+        self.resolved = 0
+    
+    def count_rows(self, rows):
+        artist_genres = self.state.artist_genres
+        new_artists = list(dict.fromkeys(
+            artist_id for _, _, artist_id in rows
+            if artist_id and artist_id not in artist_genres and artist_id not in self.waiting
+        ))
+        if new_artists:
+            #Artists already looked up by any worker or user come from the shared on-disk cache
+            cached = load_cached_artist_genres(new_artists)
+            for artist_id, genres in cached.items():
+                self.state.set_artist_genres(artist_id, genres)
+            metrics.inc('cache_hits_total', len(cached), cache='artist_genres')
+            metrics.inc('cache_misses_total', len(new_artists) - len(cached), cache='artist_genres')
+        ready = []
+        for row in rows:
+            artist_id = row[2]
+            if not artist_id or artist_id in artist_genres:
+                ready.append(row)
+            elif artist_id in self.waiting:
+                self.waiting[artist_id].append(row)
+            else:
+                self.waiting[artist_id] = [row]
+                self.found += 1
+        self.state.count_rows(ready)
+        while len(self.waiting) >= ARTIST_BATCH_SIZE:
+            self.resolve_batch()
+    
+    def flush(self):
+        #Resolves every waiting artist, the last batch may be partial
+        while self.waiting:
+            self.resolve_batch()
+    
+    def resolve_batch(self):
+        batch = list(islice(self.waiting, ARTIST_BATCH_SIZE))
+        with metrics.span('resolve_artists'):
+            batch_genres = fetch_artist_genres(self.sp, batch)
+        for artist_id in batch:
+            if artist_id in batch_genres:
+                self.state.set_artist_genres(artist_id, batch_genres[artist_id])
+            else:
+                #Counted without genres for now, looked up again when more of their tracks turn up or by the next analysis
+                self.state.unresolved_artists.add(artist_id)
+            self.state.count_rows(self.waiting.pop(artist_id))
+        self.resolved += len(batch)
+        self.progress('artists_resolved', done=self.resolved, total=self.found)
+
+def recheck_artist_genres(sp, state, artist_ids):
+    #Looks the artists up again, on-disk cache first, and updates the counts of their tracks. Artists that fail again
+    #keep the genres they had, or stay unresolved
+    found = load_cached_artist_genres(artist_ids)
+    missing = [artist_id for artist_id in artist_ids if artist_id not in found]
+    for i in range(0, len(missing), ARTIST_BATCH_SIZE):
+        found.update(fetch_artist_genres(sp, missing[i:i+ARTIST_BATCH_SIZE]))
+    for artist_id, genres in found.items():
+        state.set_artist_genres(artist_id, genres)
+
+class LibraryState:
+    #Per-playlist contributions and the counters derived from them. Kept between analyses so a
+    #refresh only applies the difference made by playlists whose snapshot changed
+    def __init__(self):
+        self.playlists = {} #Playlist ID -> (snapshot_id, [(track_id, track_uri, artist_id), ...])
+        self.artist_genres = {} #Artist ID -> genres, for every artist in the library whose lookup succeeded
+        self.unresolved_artists = set() #Artists whose lookup failed, their tracks count without genres until it succeeds
+        self.artists_checked_at = time.time() #When artist_genres was last looked up again in full
+        self.track_refs = Counter() #Track ID -> number of playlist entries for it
+        self.artist_refs = Counter() #Artist ID -> number of unique tracks by them
+        self.genre_counter = Counter() #Genre -> number of unique tracks with it
+    
+    def copy(self):
+        #Rows lists are only appended to after start_playlist replaced them, so sharing them with the copy is safe
+        state = LibraryState()
+        state.playlists = dict(self.playlists)
+        state.artist_genres = dict(self.artist_genres)
+        state.unresolved_artists = set(self.unresolved_artists)
+        state.artists_checked_at = self.artists_checked_at
+        state.track_refs = Counter(self.track_refs)
+        state.artist_refs = Counter(self.artist_refs)
+        state.genre_counter = Counter(self.genre_counter)
+        return state
+    
+    def snapshot_of(self, playlist_id):
+        entry = self.playlists.get(playlist_id)
+        return entry[0] if entry else None
+    
+    def set_playlist(self, playlist_id, snapshot_id, rows):
+        self.start_playlist(playlist_id, snapshot_id)
+        self.append_rows(playlist_id, rows)
+        self.count_rows(rows)
+    
+    def start_playlist(self, playlist_id, snapshot_id):
+        #Replaces the playlist's contribution with an empty one, filled page by page with append_rows and count_rows
+        self.remove_playlist(playlist_id)
+        self.playlists[playlist_id] = (snapshot_id, [])
+    
+    def append_rows(self, playlist_id, rows):
+        self.playlists[playlist_id][1].extend(rows)
+    
+    def set_artist_genres(self, artist_id, genres):
+        #Records an artist's genres, moving the tracks of theirs already counted from their old genres to the new ones
+        tracks = self.artist_refs.get(artist_id, 0)
+        if tracks:
+            for genre in self.artist_genres.get(artist_id, []):
+                self.genre_counter[genre] -= tracks
+                if self.genre_counter[genre] <= 0:
+                    del self.genre_counter[genre]
+            for genre in genres:
+                self.genre_counter[genre] += tracks
+        self.artist_genres[artist_id] = genres
+        self.unresolved_artists.discard(artist_id)
+    
+    def count_rows(self, rows):
+        #Adds stored rows to the counters, their artists' genres have to be in artist_genres by now
+        for track_id, _, artist_id in rows:
+            self.track_refs[track_id] += 1
+            #Genres only count the first time a track appears anywhere in the library
+            if self.track_refs[track_id] == 1 and artist_id:
+                self.artist_refs[artist_id] += 1
+                self.genre_counter.update(self.artist_genres.get(artist_id, []))
+    
+    def remove_playlist(self, playlist_id):
+        _, rows = self.playlists.pop(playlist_id, (None, []))
+        for track_id, _, artist_id in rows:
+            self.track_refs[track_id] -= 1
+            if self.track_refs[track_id] > 0:
+                continue #Still in another playlist
+            del self.track_refs[track_id]
+            if not artist_id:
+                continue
+            self.artist_refs[artist_id] -= 1
+            if self.artist_refs[artist_id] <= 0:
+                del self.artist_refs[artist_id]
+            for genre in self.artist_genres.get(artist_id, []):
+                self.genre_counter[genre] -= 1
+                if self.genre_counter[genre] <= 0:
+                    del self.genre_counter[genre]
+
+class TrackGenreTable:
+    #Compact form of the (genre, track_uri) pairs: every genre and URI string is stored once
+    #and each pair is just two integer IDs in array columns
+    def __init__(self):
+        self.genres = [] #Genre ID -> genre name
+        self.uris = [] #Track ID -> track URI
+        self.genre_ids = array('I') #Column of genre IDs, one per pair
+        self.track_ids = array('I') #Column of track IDs, one per pair
+        self._genre_lookup = {} #Genre name -> genre ID
+    
+    def add_track(self, uri, genres):
+        #Each track is added once, so its ID is simply its position
+        track_id = len(self.uris)
+        self.uris.append(uri)
+        for genre in genres:
+            genre_id = self._genre_lookup.get(genre)
+            if genre_id is None:
+                genre_id = self._genre_lookup[genre] = len(self.genres)
+                self.genres.append(genre)
+            self.genre_ids.append(genre_id)
+            self.track_ids.append(track_id)
+    
+    #Tuple view so code written for the old list of pairs keeps working
+    def __len__(self):
+        return len(self.genre_ids)
+    
+    def __getitem__(self, i):
+        return self.genres[self.genre_ids[i]], self.uris[self.track_ids[i]]
+    
+    def __iter__(self):
+        genres, uris = self.genres, self.uris
+        for genre_id, track_id in zip(self.genre_ids, self.track_ids):
+            yield genres[genre_id], uris[track_id]
+
+class GenreIndex:
+    #Built once per analysis so playlist creation doesn't rescan every (genre, uri) pair
+    def __init__(self, table):
+        self._uris = table.uris
+        #Lowercased genre -> unique track IDs in the order they were found. A track's pairs are next to each other
+        #and track IDs only grow, so a repeat of a genre for the same track is always the array's last entry
+        self.tracks_by_genre = {}
+        for genre_id, track_id in zip(table.genre_ids, table.track_ids):
+            genre = table.genres[genre_id].lower()
+            track_ids = self.tracks_by_genre.get(genre)
+            if track_ids is None:
+                track_ids = self.tracks_by_genre[genre] = array('I')
+            if not track_ids or track_ids[-1] != track_id:
+                track_ids.append(track_id)
+        
+        #Every suffix of every genre name, encoded as genre position * stride + offset and sorted by the
+        #suffix text. A genre contains the query exactly when one of its suffixes starts with it, so
+        #partial matches like "rock" -> "indie rock" are a binary search instead of a scan
+        self._genres = list(self.tracks_by_genre)
+        self._stride = max(map(len, self._genres), default=0) + 1
+        self._suffixes = array('I', sorted(
+            (pos * self._stride + offset for pos, genre in enumerate(self._genres) for offset in range(len(genre))),
+            key=self._suffix
+        ))
+    
+    def _suffix(self, entry):
+        pos, offset = divmod(entry, self._stride)
+        return self._genres[pos][offset:]
+    
+    def matching_genres(self, query):
+        #Genres equal to or containing query, the exact match first and the rest in discovery order
+        query = query.lower()
+        positions = set()
+        for entry in self._suffixes[bisect_left(self._suffixes, query, key=self._suffix):]:
+            if not self._suffix(entry).startswith(query):
+                break
+            positions.add(entry // self._stride)
+        matches = [self._genres[pos] for pos in sorted(positions)]
+        if query in self.tracks_by_genre:
+            matches.remove(query)
+            matches.insert(0, query)
+        return matches
+    
+    def lookup(self, query):
+        #Unique track URIs for every genre matching query, keeping track order
+        track_ids = {}
+        for genre in self.matching_genres(query):
+            track_ids.update(dict.fromkeys(self.tracks_by_genre[genre]))
+        return [self._uris[track_id] for track_id in track_ids]
+
+def iter_playlists(sp):
+    #The user's playlists as (id, name, snapshot_id), one page at a time
+    results = sp.current_user_playlists(limit=PLAYLISTS_PAGE_SIZE)
+    while True:
+        for playlist in results['items']:
+            yield playlist['id'], playlist['name'], playlist.get('snapshot_id')
+        if not results['next']:
+            return
+        results = sp.next(results)
+
+def iter_playlist_rows(sp, playlist_id, snapshot_id=None):
+    #A playlist's tracks as compact rows, one list per page. Playlists any user's analysis has already fetched at this
+    #snapshot are read from the shared playlist cache, others are fetched and stored there page by page
+    if not snapshot_id:
+        yield from fetch_playlist_rows(sp, playlist_id)
+        return
+    pages = cached_playlist_pages(playlist_id, snapshot_id)
+    if pages is not None:
+        metrics.inc('cache_hits_total', cache='playlist_contents')
+        for page in range(pages):
+            rows = load_playlist_page(playlist_id, snapshot_id, page)
+            if rows is None:
+                #Cached pages are the API's pages, so the rest of the playlist is fetched from where the cache stopped
+                forget_playlist_contents(playlist_id, snapshot_id)
+                yield from fetch_playlist_rows(sp, playlist_id, page)
+                return
+            yield rows
+        return
+    metrics.inc('cache_misses_total', cache='playlist_contents')
+    pages = 0
+    for rows in fetch_playlist_rows(sp, playlist_id):
+        store_playlist_page(playlist_id, snapshot_id, pages, rows)
+        pages += 1
+        yield rows
+    store_playlist_contents(playlist_id, snapshot_id, pages)
+
+def fetch_playlist_rows(sp, playlist_id, start_page=0):
+    #A playlist's rows from the API, one list per page. Each page's JSON is dropped before its rows are handed on
+    with metrics.span('fetch_page'):
+        #The next page URLs keep the fields filter and page size
+        results = sp.playlist_items(
+            playlist_id,
+            fields=PLAYLIST_ITEM_FIELDS,
+            limit=PLAYLIST_ITEMS_PAGE_SIZE,
+            offset=start_page * PLAYLIST_ITEMS_PAGE_SIZE,
+            additional_types=('track',)
+        )
+    while True:
+        rows = track_rows(results['items'])
+        next_page = {'next': results['next']}
+        results = None
+        yield rows
+        if not next_page['next']:
+            return
+        with metrics.span('fetch_page'):
+            results = sp.next(next_page)
+
+def track_rows(items):
+    #Turns playlist items into (track_id, track_uri, artist_id) rows, artist_id is None when the track has no artist information
+    rows = []
+    for item in items:
+        track = item.get('track')
+        if not track or not track.get('id'):
+            continue #Skipping invalid tracks
+        artists = track.get('artists')
+        artist_id = artists[0].get('id') if artists else None
+        rows.append((track['id'], track['uri'], artist_id))
+    return rows
+
+def log_progress(event, **fields):
+    #Default progress handler for analyses run outside a job, per playlist and per batch events are debug level
+    level = logging.INFO if event in ('playlists_listed', 'analysis_complete') else logging.DEBUG
+    if log.isEnabledFor(level):
+        log.log(level, "%s: %s", event, ", ".join(f"{name}={value}" for name, value in fields.items()))
+
+class Job:
+    #A unit of work running on job_executor, its progress is reported as structured events
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'running'
+        self.error = None
+        self.progress = {} #Event name -> fields of the latest event with that name
+        self.events = deque(maxlen=50) #Most recent events in order
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+    
+    def report(self, event, **fields):
+        #Used as the progress callback, may be called from several threads
+        with self._lock:
+            self.progress[event] = fields
+            self.events.append({'event': event, **fields})
+    
+    def increment(self, event, **amounts):
+        #Adds to the numeric fields of an event, for progress reported from several threads at once
+        with self._lock:
+            fields = dict(self.progress.get(event, {}))
+            for name, amount in amounts.items():
+                fields[name] = fields.get(name, 0) + amount
+            self.progress[event] = fields
+    
+    def finish(self, error=None):
+        self.status = 'error' if error else 'done'
+        self.error = error
+        self.finished_at = time.time()
+    
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'error': self.error,
+                'progress': dict(self.progress),
+                'events': list(self.events),
+                'elapsed': round((self.finished_at or time.time()) - self.started_at, 1)
+            }
+
+def start_job(kind, func, *args):
+    #Runs func(job, *args) in the background and returns the Job tracking it
+    job = Job(kind)
+    with jobs_lock:
+        #Drop finished jobs nobody has polled for a while
+        for old_id, old_job in list(jobs.items()):
+            if old_job.finished_at and time.time() - old_job.finished_at > JOB_RETENTION:
+                del jobs[old_id]
+        jobs[job.id] = job
+    
+    def run():
+        try:
+            func(job, *args)
+            job.finish()
+        except Exception as e:
+            log.exception("Job %s %s failed", job.kind, job.id)
+            job.finish(str(e))
+    
+    job_executor.submit(run)
+    return job
+
+def start_analysis_job(sp, user_id, previous):
+    #Starts analysing the user's library unless an analysis for them is already running or has just failed.
+    #Requests from this process share the running job, other processes' jobs wait on its lease (see run_analysis)
+    with jobs_lock:
+        job = jobs.get(analysis_jobs.get(user_id))
+        if job and job.status != 'done':
+            return job
+        job = start_job('analysis', run_analysis, sp, user_id, previous)
+        analysis_jobs[user_id] = job.id
+        return job
+
+def finish_analysis_job(user_id, job):
+    with jobs_lock:
+        if analysis_jobs.get(user_id) == job.id:
+            del analysis_jobs[user_id]
+
+def run_analysis(job, sp, user_id, previous):
+    #Only one analysis per user runs across all worker processes, the job waits while another worker's holds the lease
+    while not acquire_analysis_lease(user_id, job.id):
+        job.report('waiting_for_analysis')
+        time.sleep(ANALYSIS_LEASE_POLL)
+        if analysis_is_fresh(user_id):
+            return
+    stop_renewing = threading.Event()
+    
+    def renew():
+        while not stop_renewing.wait(ANALYSIS_LEASE_TTL / 3):
+            renew_analysis_lease(user_id, job.id)
+    
+    threading.Thread(target=renew, daemon=True).start()
+    try:
+        #The other worker may have finished between its lease being released and this job taking it
+        if analysis_is_fresh(user_id):
+            return
+        with metrics.span('analysis'):
+            genre_data = analyse_genres(sp, previous=previous, progress=job.report)
+        #Store the data in server cache, otherwise would have problems acessing the data as its too large for session cookies
+        store_analysis(user_id, genre_data)
+    finally:
+        stop_renewing.set()
+        release_analysis_lease(user_id, job.id)
+
+def analysis_is_fresh(user_id):
+    #True once an analysis that isn't waiting to be refreshed is cached, or has just been saved by another worker
+    genre_data = genre_data_cache.get(user_id)
+    if not genre_data or genre_data.get('stale'):
+        #Called every ANALYSIS_LEASE_POLL while waiting, so a snapshot is only unpickled once it is fresh
+        genre_data = load_analysis_snapshot(user_id, fresh_only=True)
+        if genre_data:
+            genre_data_cache.set(user_id, genre_data)
+    return bool(genre_data) and not genre_data.get('stale')
+
+def acquire_analysis_lease(user_id, owner):
+    #Takes the user's analysis lease unless a different owner holds one that hasn't expired
+    now = time.time()
+    try:
+        with cache_transaction() as conn:
+            row = conn.execute("SELECT owner, expires_at FROM analysis_leases WHERE user_id = ?", (user_id,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO analysis_leases VALUES (?, ?, ?)", (user_id, owner, now + ANALYSIS_LEASE_TTL))
+            return True
+    except sqlite3.Error as e:
+        #Without the shared lease workers may analyse the same user twice, which is only wasted work
+        log.warning("Analysis lease unavailable: %s", e)
+        return True
+
+def renew_analysis_lease(user_id, owner):
+    try:
+        with cache_transaction() as conn:
+            conn.execute(
+                "UPDATE analysis_leases SET expires_at = ? WHERE user_id = ? AND owner = ?",
+                (time.time() + ANALYSIS_LEASE_TTL, user_id, owner)
+            )
+    except sqlite3.Error as e:
+        log.warning("Analysis lease unavailable: %s", e)
+
+def release_analysis_lease(user_id, owner):
+    try:
+        with cache_transaction() as conn:
+            conn.execute("DELETE FROM analysis_leases WHERE user_id = ? AND owner = ?", (user_id, owner))
+    except sqlite3.Error as e:
+        log.warning("Analysis lease unavailable: %s", e)
+
+def genre_playlist_name(genre):
+    return f"{genre.title()} - My Collection"
+
+def create_genre_playlist_for(sp, user_id, genre):
+    with metrics.span('create_playlist'):
+        return sp.user_playlist_create(
+            user_id, 
+            genre_playlist_name(genre), 
+            public=False, 
+            description=f"Curated {genre} playlist created by Genre Analyser"
+        )
+
+def start_playlist_write(sp, playlist_id, track_uris):
+    #Adds the tracks to the playlist on a background job so the request can return straight away
+    return start_job('playlist_write', write_playlist, sp, playlist_id, track_uris)
+
+def write_playlist(job, sp, playlist_id, track_uris):
+    job.report('tracks_added', done=0, failed=0, total=len(track_uris))
+    failed = add_tracks_in_order(job, sp, playlist_id, track_uris)
+    if failed:
+        raise Exception(f"{failed} of {len(track_uris)} tracks could not be added")
+
+def write_genre_playlists(job, sp, user_id, genre_tracks):
+    #Creates and fills a playlist per (genre, track URIs) pair, several playlists at a time
+    total_tracks = sum(len(track_uris) for _, track_uris in genre_tracks)
+    job.report('tracks_added', done=0, failed=0, total=total_tracks)
+    job.report('playlists_created', done=0, total=len(genre_tracks))
+    
+    def create_and_fill(genre, track_uris):
+        playlist = create_genre_playlist_for(sp, user_id, genre)
+        job.increment('playlists_created', done=1)
+        job.report('playlist_created', name=genre_playlist_name(genre), url=playlist['external_urls']['spotify'])
+        return add_tracks_in_order(job, sp, playlist['id'], track_uris)
+    
+    with ThreadPoolExecutor(max_workers=PLAYLIST_WRITE_WORKERS) as executor:
+        failed = sum(executor.map(lambda pair: create_and_fill(*pair), genre_tracks))
+    if failed:
+        raise Exception(f"{failed} of {total_tracks} tracks could not be added")
+
+def add_tracks_in_order(job, sp, playlist_id, track_uris):
+    #Adds tracks in batches, each inserted at an explicit position so the playlist keeps the given order.
+    #Writes to one playlist are applied one after another by Spotify, so batches are sent in sequence and
+    #a batch that failed for a transient reason is retried on its own without resending the ones before it.
+    #Returns how many tracks failed
+    added = 0
+    failed = 0
+    for start in range(0, len(track_uris), PLAYLIST_BATCH_SIZE):
+        batch = track_uris[start:start+PLAYLIST_BATCH_SIZE]
+        for attempt in range(PLAYLIST_WRITE_RETRIES + 1):
+            try:
+                with metrics.span('playlist_write'):
+                    sp.playlist_add_items(playlist_id, batch, position=added)
+                added += len(batch)
+                job.increment('tracks_added', done=len(batch))
+                break
+            except Exception as e:
+                if attempt == PLAYLIST_WRITE_RETRIES or not is_transient_error(e):
+                    failed += len(batch)
+                    job.increment('tracks_added', failed=len(batch))
+                    job.report('batch_failed', playlist=playlist_id, start=start, tracks=len(batch), error=str(e))
+                    break
+                time.sleep(2 ** attempt)
+    return failed
+
+def is_transient_error(error):
+    #Server errors, throttling that outlasted the adapter's retries and network failures are worth retrying,
+    #other answers such as 403, 404 or an invalid track URI will be the same next time
+    if isinstance(error, spotipy.exceptions.SpotifyException):
+        return error.http_status == 429 or (error.http_status or 0) >= 500
+    return isinstance(error, requests.exceptions.RequestException)
+
+def search_genre_tracks(sp, genre, market, offset):
+    #One page of tracks for a genre search, cached by (genre, market, offset)
+    key = f"{genre.lower().strip()}|{market or ''}|{offset}"
+    page = search_cache.get(key)
+    if page is not None:
+        return page
+    
+    results = sp.search(q=f'genre:"{genre}"', type='track', limit=SEARCH_PAGE_SIZE, offset=offset, market=market)['tracks']
+    next_offset = offset + SEARCH_PAGE_SIZE
+    #Only what the search page shows is kept
+    page = {
+        'tracks': [
+            {'uri': track['uri'], 'name': track['name'], 'artists': ', '.join(artist['name'] for artist in track['artists'])}
+            for track in results['items'] if track
+        ],
+        'next_offset': next_offset if results.get('next') and next_offset < SEARCH_MAX_OFFSET else None
     }
+    search_cache.set(key, page)
+    return page
+
+def prefetch_search_page(sp, genre, market, offset):
+    #Loads a search page into the cache in the background, at most once at a time per page
+    if offset is None:
+        return
+    key = f"{genre.lower().strip()}|{market or ''}|{offset}"
+    with prefetch_lock:
+        if key in prefetching:
+            return
+        prefetching.add(key)
+    
+    def prefetch():
+        try:
+            search_genre_tracks(sp, genre, market, offset)
+        except Exception as e:
+            log.warning("Prefetching search page %s failed: %s", key, e)
+        finally:
+            with prefetch_lock:
+                prefetching.discard(key)
+    
+    prefetch_executor.submit(prefetch)
+
+def fetch_artist_genres(sp, artist_ids):
+    #Genres of up to ARTIST_BATCH_SIZE artists from the multi-artist endpoint, saved to the on-disk cache.
+    #Artists in a failed batch are left out so their tracks are skipped, as before
+    try:
+        artists = sp.artists(artist_ids)['artists']
+    except Exception as e:
+        log.warning("Error fetching artists %s..%s: %s", artist_ids[0], artist_ids[-1], e)
+        return {}
+    batch_genres = {artist_id: (artist.get('genres', []) if artist else []) for artist_id, artist in zip(artist_ids, artists)}
+    store_artist_genres(batch_genres)
+    return batch_genres
+
+def cache_db():
+    #Returns this thread's connection to the shared cache database, creating the tables on first use
+    conn = getattr(_cache_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(CACHE_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL") #Lets readers in other processes work while one process writes
+        conn.execute("PRAGMA synchronous=NORMAL") #Safe with WAL and keeps the rate limiter's frequent writes cheap
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS artist_genres ("
+            "artist_id TEXT PRIMARY KEY, genres TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS artist_genres_fetched_at ON artist_genres (fetched_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit ("
+            "id INTEGER PRIMARY KEY, rate REAL, tokens REAL, updated_at REAL, blocked_until REAL, throttle_events INTEGER)"
+        )
+        #A playlist snapshot's pages are stored as they are fetched, its playlist_contents row is only added once the
+        #last page is in, so only complete playlists are read back
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS playlist_pages ("
+            "playlist_id TEXT NOT NULL, snapshot_id TEXT NOT NULL, page INTEGER NOT NULL, rows BLOB NOT NULL, "
+            "fetched_at REAL NOT NULL, PRIMARY KEY (playlist_id, snapshot_id, page))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS playlist_pages_fetched_at ON playlist_pages (fetched_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS playlist_contents ("
+            "playlist_id TEXT NOT NULL, snapshot_id TEXT NOT NULL, pages INTEGER NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (playlist_id, snapshot_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS playlist_contents_fetched_at ON playlist_contents (fetched_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_leases ("
+            "user_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_snapshots ("
+            "user_id TEXT PRIMARY KEY, schema INTEGER NOT NULL, stale INTEGER NOT NULL, data BLOB NOT NULL, stored_at REAL NOT NULL)"
+        )
+        _cache_db_local.conn = conn
+    return conn
+
+@contextmanager
+def cache_transaction():
+    #BEGIN IMMEDIATE takes the database write lock up front, so two processes can't both read then write the same row
+    conn = cache_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def load_cached_artist_genres(artist_ids):
+    #Returns {artist_id: genres} for the artists with a cached entry younger than ARTIST_CACHE_TTL
+    found = {}
+    oldest = time.time() - ARTIST_CACHE_TTL
+    try:
+        conn = cache_db()
+        #Chunked to stay under SQLite's limit on query parameters
+        for i in range(0, len(artist_ids), 500):
+            chunk = artist_ids[i:i+500]
+            rows = conn.execute(
+                f"SELECT artist_id, genres FROM artist_genres WHERE fetched_at > ? AND artist_id IN ({','.join('?' * len(chunk))})",
+                [oldest, *chunk]
+            )
+            for artist_id, genres in rows:
+                found[artist_id] = json.loads(genres)
+    except sqlite3.Error as e:
+        #The on-disk cache is only an optimisation, so fall back to the API
+        log.warning("Artist cache unavailable: %s", e)
+    return found
+
+def store_artist_genres(genres_by_artist):
+    #Saves freshly fetched artist genres and evicts expired or excess entries
+    now = time.time()
+    try:
+        conn = cache_db()
+        conn.executemany(
+            "INSERT OR REPLACE INTO artist_genres (artist_id, genres, fetched_at) VALUES (?, ?, ?)",
+            [(artist_id, json.dumps(genres), now) for artist_id, genres in genres_by_artist.items()]
+        )
+        conn.execute("DELETE FROM artist_genres WHERE fetched_at <= ?", (now - ARTIST_CACHE_TTL,))
+        excess = conn.execute("SELECT COUNT(*) FROM artist_genres").fetchone()[0] - ARTIST_CACHE_MAX_ENTRIES
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM artist_genres WHERE artist_id IN "
+                "(SELECT artist_id FROM artist_genres ORDER BY fetched_at LIMIT ?)",
+                (excess,)
+            )
+    except sqlite3.Error as e:
+        log.warning("Could not update artist cache: %s", e)
+
+def cached_playlist_pages(playlist_id, snapshot_id):
+    #Number of pages cached for this playlist snapshot, None unless all of them are
+    try:
+        row = cache_db().execute(
+            "SELECT pages, (SELECT COUNT(*) FROM playlist_pages p WHERE p.playlist_id = c.playlist_id AND p.snapshot_id = c.snapshot_id) "
+            "FROM playlist_contents c WHERE playlist_id = ? AND snapshot_id = ? AND fetched_at > ?",
+            (playlist_id, snapshot_id, time.time() - PLAYLIST_CACHE_TTL)
+        ).fetchone()
+    except sqlite3.Error as e:
+        log.warning("Playlist cache unavailable: %s", e)
+        return None
+    if row is None:
+        return None
+    pages, stored_pages = row
+    if stored_pages != pages:
+        #Some pages were deleted, fetch the playlist again rather than leave it out
+        forget_playlist_contents(playlist_id, snapshot_id)
+        return None
+    return pages
+
+def load_playlist_page(playlist_id, snapshot_id, page):
+    #The page's rows, None if it can't be read
+    try:
+        row = cache_db().execute(
+            "SELECT rows FROM playlist_pages WHERE playlist_id = ? AND snapshot_id = ? AND page = ?",
+            (playlist_id, snapshot_id, page)
+        ).fetchone()
+        if row is None:
+            return None
+        rows = json.loads(zlib.decompress(row[0]))
+    except (sqlite3.Error, zlib.error, ValueError) as e:
+        log.warning("Playlist cache unavailable: %s", e)
+        return None
+    #Rows are stored without their URI when it is the usual one for the track ID
+    return [(row[0], row[2] if len(row) > 2 else "spotify:track:" + row[0], row[1]) for row in rows]
+
+def forget_playlist_contents(playlist_id, snapshot_id):
+    try:
+        cache_db().execute("DELETE FROM playlist_contents WHERE playlist_id = ? AND snapshot_id = ?", (playlist_id, snapshot_id))
+    except sqlite3.Error as e:
+        log.warning("Could not update playlist cache: %s", e)
+
+def store_playlist_page(playlist_id, snapshot_id, page, rows):
+    compact = [
+        [track_id, artist_id] if track_uri == "spotify:track:" + track_id else [track_id, artist_id, track_uri]
+        for track_id, track_uri, artist_id in rows
+    ]
+    try:
+        cache_db().execute(
+            "INSERT OR REPLACE INTO playlist_pages (playlist_id, snapshot_id, page, rows, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            (playlist_id, snapshot_id, page, zlib.compress(json.dumps(compact, separators=(',', ':')).encode()), time.time())
+        )
+    except sqlite3.Error as e:
+        log.warning("Could not update playlist cache: %s", e)
+
+def store_playlist_contents(playlist_id, snapshot_id, pages):
+    #Marks the snapshot's pages complete and drops the playlist's older snapshots, nobody will ask for those again.
+    #Snapshots whose fetch started after this one's are newer and may still be being stored, so they are kept
+    try:
+        with cache_transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO playlist_contents (playlist_id, snapshot_id, pages, fetched_at) VALUES (?, ?, ?, ?)",
+                (playlist_id, snapshot_id, pages, time.time())
+            )
+            older = (
+                "SELECT snapshot_id FROM playlist_pages WHERE playlist_id = ? AND page = 0 AND snapshot_id != ? AND fetched_at < "
+                "(SELECT fetched_at FROM playlist_pages WHERE playlist_id = ? AND snapshot_id = ? AND page = 0)"
+            )
+            arguments = (playlist_id, playlist_id, snapshot_id, playlist_id, snapshot_id)
+            conn.execute(f"DELETE FROM playlist_contents WHERE playlist_id = ? AND snapshot_id IN ({older})", arguments)
+            conn.execute(f"DELETE FROM playlist_pages WHERE playlist_id = ? AND snapshot_id IN ({older})", arguments)
+    except sqlite3.Error as e:
+        log.warning("Could not update playlist cache: %s", e)
+
+def evict_playlist_contents():
+    #Deletes expired or excess cached playlists, then pages no complete playlist uses that are too old to belong to a
+    #fetch still in progress. Run once per analysis rather than per playlist since it scans the tables
+    now = time.time()
+    try:
+        conn = cache_db()
+        conn.execute("DELETE FROM playlist_contents WHERE fetched_at <= ?", (now - PLAYLIST_CACHE_TTL,))
+        excess = conn.execute("SELECT COUNT(*) FROM playlist_contents").fetchone()[0] - PLAYLIST_CACHE_MAX_ENTRIES
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM playlist_contents WHERE rowid IN "
+                "(SELECT rowid FROM playlist_contents ORDER BY fetched_at LIMIT ?)",
+                (excess,)
+            )
+        conn.execute(
+            "DELETE FROM playlist_pages WHERE fetched_at <= ? AND NOT EXISTS (SELECT 1 FROM playlist_contents c "
+            "WHERE c.playlist_id = playlist_pages.playlist_id AND c.snapshot_id = playlist_pages.snapshot_id)",
+            (now - 3600,)
+        )
+    except sqlite3.Error as e:
+        log.warning("Could not update playlist cache: %s", e)
+
+def render_page(template, **context):
+    #render_template, timed as the render span of its template
+    with metrics.span('render', template=template):
+        return render_template(template, **context)
 
 def render_error(message):
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Error</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                max-width: 600px;
-                margin: 100px auto;
-                padding: 20px;
-                background: linear-gradient(135deg, #e74c3c 0%, #c0392b 100%);
-                min-height: 100vh;
-            }}
-            .container {{
-                background: white;
-                border-radius: 15px;
-                padding: 40px;
-                text-align: center;
-            }}
-            h1 {{ color: #e74c3c; }}
-            .button {{
-                display: inline-block;
-                padding: 12px 24px;
-                background: #535353;
-                color: white;
-                text-decoration: none;
-                border-radius: 25px;
-                margin-top: 20px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>Error</h1>
-            <p>{message}</p>
-            <a href="/dashboard" class="button">Back to Dashboard</a>
-        </div>
-    </body>
-    </html>
-    '''
-
-def render_success(message, playlist_url=None):
-    playlist_link = f'<a href="{playlist_url}" class="button" target="_blank">Open in Spotify</a>' if playlist_url else ''
-    
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Success</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                max-width: 600px;
-                margin: 100px auto;
-                padding: 20px;
-                background: linear-gradient(135deg, #1DB954 0%, #169c46 100%);
-                min-height: 100vh;
-            }}
-            .container {{
-                background: white;
-                border-radius: 15px;
-                padding: 40px;
-                text-align: center;
-            }}
-            h1 {{ color: #1DB954; }}
-            .button {{
-                display: inline-block;
-                padding: 12px 24px;
-                background: #1DB954;
-                color: white;
-                text-decoration: none;
-                border-radius: 25px;
-                margin: 10px;
-                font-weight: bold;
-            }}
-            .button:hover {{
-                background: #1ed760;
-            }}
-            .button-secondary {{
-                background: #535353;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>Success</h1>
-            <p>{message}</p>
-            {playlist_link}
-            <a href="/dashboard" class="button button-secondary">Back to Dashboard</a>
-        </div>
-    </body>
-    </html>
-    '''
+    return render_page("error.html", message=message)
+
+def render_progress(job_id, message):
+    #Page shown while a background job runs, polls the job status and reloads once it is done
+    return render_page("progress.html", job_id=job_id, message=message)
+
+def render_success(message, playlist_url=None, job_id=None):
+    #When tracks are still being added by a background job, the page shows its progress
+    return render_page("success.html", message=message, playlist_url=playlist_url, job_id=job_id)
+
+@app.template_global()
+def static_url(filename):
+    #Static file URL with a content hash, so a changed file gets a new URL and old ones can be cached for good
+    version = static_versions.get(filename)
+    if version is None:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = hashlib.md5(f.read()).hexdigest()[:12]
+        static_versions[filename] = version
+    return url_for('static', filename=filename, v=version)
+
+def etag_for(*parts):
+    #ETag for a page or JSON view built from parts, e.g. the analysis version it shows
+    global assets_version
+    if assets_version is None:
+        digest = hashlib.md5()
+        for folder in (os.path.join(app.root_path, app.template_folder), app.static_folder):
+            for root, _, files in sorted(os.walk(folder)):
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        digest.update(f.read())
+        assets_version = digest.hexdigest()
+    return hashlib.sha1(repr((assets_version,) + parts).encode()).hexdigest()[:20]
+
+def not_modified(etag):
+    #Empty 304 response if the client's copy (If-None-Match) is still current, otherwise None
+    if etag in request.if_none_match:
+        return conditional(app.response_class(status=304), etag)
+    return None
+
+def conditional(response, etag):
+    response = make_response(response)
+    response.set_etag(etag)
+    #Pages are per user, browsers may keep them but have to revalidate with the ETag before reusing them
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def mark_analysis_stale(user_id):
+    #Keeps the cached analysis (it is the starting point of the incremental refresh) but flags it for re-analysis
+    genre_data = get_analysis(user_id)
+    if not genre_data:
+        return False
+    genre_data['stale'] = True
+    genre_data_cache.set(user_id, genre_data)
+    try:
+        cache_db().execute("UPDATE analysis_snapshots SET stale = 1 WHERE user_id = ?", (user_id,))
+    except sqlite3.Error as e:
+        log.warning("Analysis snapshots unavailable: %s", e)
+    return True
+
+def get_analysis(user_id):
+    #The user's analysis from the in-memory cache, or loaded from its snapshot the first time it's needed after a
+    #restart or eviction
+    genre_data = genre_data_cache.get(user_id)
+    if genre_data is None:
+        genre_data = load_analysis_snapshot(user_id)
+        if genre_data is not None:
+            genre_data_cache.set(user_id, genre_data)
+    return genre_data
+
+def store_analysis(user_id, genre_data):
+    genre_data_cache.set(user_id, genre_data)
+    save_analysis_snapshot(user_id, genre_data)
+
+def save_analysis_snapshot(user_id, genre_data):
+    #Replaces the user's snapshot and deletes expired ones
+    with metrics.span('save_snapshot'):
+        data = zlib.compress(pickle.dumps(genre_data, pickle.HIGHEST_PROTOCOL))
+    now = time.time()
+    try:
+        conn = cache_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_snapshots (user_id, schema, stale, data, stored_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, ANALYSIS_SNAPSHOT_SCHEMA, int(bool(genre_data.get('stale'))), data, now)
+        )
+        conn.execute("DELETE FROM analysis_snapshots WHERE stored_at <= ?", (now - ANALYSIS_SNAPSHOT_MAX_AGE,))
+    except sqlite3.Error as e:
+        #Snapshots only save re-analysing after a restart, the analysis itself is still cached in memory
+        log.warning("Analysis snapshots unavailable: %s", e)
+
+def load_analysis_snapshot(user_id, fresh_only=False):
+    #Returns the user's saved analysis, None if there is no current snapshot with this schema (or it is stale and
+    #fresh_only is set)
+    try:
+        row = cache_db().execute(
+            "SELECT data, stale FROM analysis_snapshots WHERE user_id = ? AND schema = ? AND stored_at > ?"
+            + (" AND stale = 0" if fresh_only else ""),
+            (user_id, ANALYSIS_SNAPSHOT_SCHEMA, time.time() - ANALYSIS_SNAPSHOT_MAX_AGE)
+        ).fetchone()
+    except sqlite3.Error as e:
+        log.warning("Analysis snapshots unavailable: %s", e)
+        return None
+    if row is None:
+        return None
+    data, stale = row
+    try:
+        with metrics.span('load_snapshot'):
+            genre_data = pickle.loads(zlib.decompress(data))
+    except Exception as e:
+        #e.g. the classes it was pickled from changed without the schema being bumped, so analyse again
+        log.warning("Ignoring unreadable analysis snapshot of user %s: %s", user_id, e)
+        return None
+    if stale:
+        genre_data['stale'] = True
+    return genre_data
+
+def load_genre_data():
+    #Loads the analysis the session's handle points to from the server-side cache, None if there isn't one
+    handle = session.get(ANALYSIS_HANDLE)
+    if not handle:
+        return None
+    return get_analysis(handle['id'])
+
+def get_spotify(token_info):
+    #One Spotify client per request, built on the worker's shared HTTP session
+    sp = g.get('spotify')
+    if sp is None or sp._auth != token_info['access_token']:
+        sp = g.spotify = spotipy.Spotify(auth=token_info['access_token'], requests_session=http_session)
+        sp.prefix = spotify_api_url()
+    return sp
+
+def current_user(sp):
+    #The logged in user's ID and display name, only asks Spotify when the session doesn't have them yet
+    user = session.get(USER_INFO)
+    if not user:
+        profile = sp.me()
+        user = session[USER_INFO] = {'id': profile['id'], 'display_name': profile['display_name']}
+    return user
 
 def get_token():
     #Retrieves the Spotify access token information from the flask sesion
@@ -936,26 +1932,67 @@ def get_token():
     if not token_info:
         return redirect(url_for("login", _external=True))
     
-    #Get the current time in seconds
-    now = int(time.time())
-    
-    #Checks if the token is about to expire 
-    is_expired = token_info['expires_at'] - now < 60
+    #Seconds until the token expires
+    expires_in = token_info['expires_at'] - int(time.time())
     
-    if is_expired:
-        spotify_oauth = create_spotify_oauth() #Creates a SpotifyOAuth object if the token is/about to expired
-        token_info = spotify_oauth.refresh_access_token(token_info['refresh_token']) #Refresh the acess token using the stored refresh token
-        session[TOKEN_INFO] = token_info #Updates the session with the new token information
+    #Close to expiry the token is refreshed in the background, the request carries on with the current one and the
+    #session picks up the new token once it's ready. Only a token about to expire makes the request wait for the refresh
+    if expires_in < TOKEN_REFRESH_AHEAD:
+        refresh = refresh_token(token_info)
+        if expires_in < 60:
+            token_info = session[TOKEN_INFO] = refresh.result()
+        elif refresh.done() and not refresh.exception():
+            token_info = session[TOKEN_INFO] = refresh.result()
     return token_info #Returns the valid token information for use in API calls
 
+def refresh_token(token_info):
+    #Returns the Future refreshing this token, concurrent requests with the same token share one refresh.
+    #A refresh is started unless one is running or has returned a token that isn't about to expire itself
+    key = token_info['refresh_token']
+    now = time.time()
+    with token_refreshes_lock:
+        refresh = token_refreshes.get(key)
+        if refresh is None or (refresh.done() and not token_is_usable(refresh, now)):
+            #Forget refreshes whose tokens are no longer any use, every session holding them has refreshed again
+            for old_key, old_refresh in list(token_refreshes.items()):
+                if old_refresh.done() and not token_is_usable(old_refresh, now):
+                    del token_refreshes[old_key]
+            refresh = token_refreshes[key] = token_executor.submit(get_spotify_oauth().refresh_access_token, key)
+        return refresh
+
+def token_is_usable(refresh, now):
+    return not refresh.exception() and refresh.result()['expires_at'] - now >= 60
+
+class NoTokenCache(CacheHandler):
+    #Tokens live in each user's session, so the shared OAuth object keeps none itself (spotipy's default is a .cache
+    #file that every user's token would be written to)
+    def get_cached_token(self):
+        return None
+    
+    def save_token_to_cache(self, token_info):
+        pass
+
 def create_spotify_oauth():
     #Creates and returns a SpotifyOAuth object using the client ID, client secret, and redirect URI from environment variables
-    return SpotifyOAuth(
+    spotify_oauth = SpotifyOAuth(
         client_id=os.getenv('clientID'),
         client_secret=os.getenv("clientSecret"),
         redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
-        scope="user-library-read playlist-modify-public playlist-modify-private playlist-read-private"
+        scope="user-library-read playlist-modify-public playlist-modify-private playlist-read-private",
+        requests_session=http_session,
+        cache_handler=NoTokenCache()
     )
+    if SPOTIFY_ACCOUNTS_URL:
+        spotify_oauth.OAUTH_AUTHORIZE_URL = SPOTIFY_ACCOUNTS_URL.rstrip('/') + '/authorize'
+        spotify_oauth.OAUTH_TOKEN_URL = SPOTIFY_ACCOUNTS_URL.rstrip('/') + '/api/token'
+    return spotify_oauth
+
+def get_spotify_oauth():
+    #One OAuth object per worker process, created on first use. It holds no per-user state so every request shares it
+    global spotify_oauth
+    if spotify_oauth is None:
+        spotify_oauth = create_spotify_oauth()
+    return spotify_oauth
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,64 @@
+//Draws the dashboard charts from the analysis JSON, so the page itself holds no data
+const source = document.currentScript.dataset.src;
+
+//Generate colors
+const colors = [
+    '#1DB954', '#1ed760', '#169c46', '#117a37',
+    '#0d5c2a', '#535353', '#b3b3b3', '#ffffff',
+    '#ff6b6b', '#4ecdc4'
+];
+
+fetch(source, {credentials: 'same-origin'})
+    .then(response => response.json())
+    .then(data => {
+        const genres = data.labels;
+        const counts = data.counts;
+
+        //Bar Chart
+        new Chart(document.getElementById('barChart'), {
+            type: 'bar',
+            data: {
+                labels: genres,
+                datasets: [{
+                    label: 'Number of Tracks',
+                    data: counts,
+                    backgroundColor: colors,
+                    borderWidth: 0
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: true,
+                plugins: {
+                    legend: { display: false }
+                },
+                scales: {
+                    y: {
+                        beginAtZero: true,
+                        ticks: { precision: 0 }
+                    }
+                }
+            }
+        });
+
+        //Pie Chart
+        new Chart(document.getElementById('pieChart'), {
+            type: 'pie',
+            data: {
+                labels: genres,
+                datasets: [{
+                    data: counts,
+                    backgroundColor: colors
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: true,
+                plugins: {
+                    legend: {
+                        position: 'bottom'
+                    }
+                }
+            }
+        });
+    });
@@ -0,0 +1,69 @@
+//Polls a background job's status, either reloading the page once it is done (progress page)
+//or showing how many tracks were added (success page)
+const status = document.getElementById('job');
+
+function describe(progress) {
+    const lines = [];
+    const listed = progress.playlists_listed;
+    const playlist = progress.playlist_processed;
+    const artists = progress.artists_resolved;
+    if (progress.waiting_for_analysis && !listed) lines.push('Waiting for your analysis already running elsewhere...');
+    if (listed) lines.push(`Playlists to fetch: ${playlist ? playlist.done : 0}/${listed.changed}`);
+    if (playlist) lines.push(`Tracks found: ${playlist.tracks}`);
+    if (artists) lines.push(`Artists resolved: ${artists.done}/${artists.total}`);
+    return lines.join('<br>') || 'Starting...';
+}
+
+function showUpload(job) {
+    const added = job.progress.tracks_added;
+    if (added) status.textContent = `Added ${added.done}/${added.total} tracks`;
+    if (job.status === 'error') status.textContent = job.error;
+    //Link every playlist the job created when there was more than one
+    const created = job.events.filter(event => event.event === 'playlist_created');
+    if (job.status !== 'running' && created.length > 1) {
+        for (const playlist of created) {
+            const link = document.createElement('a');
+            link.href = playlist.url;
+            link.target = '_blank';
+            link.className = 'button';
+            link.textContent = playlist.name;
+            status.after(link);
+        }
+    }
+}
+
+//Failed polls in a row. Jobs only exist on the worker process that started them and are forgotten JOB_RETENTION
+//seconds after finishing, so a poll can get a 404 (or a network error)
+let failures = 0;
+
+async function poll() {
+    let job = null;
+    try {
+        const response = await fetch(status.dataset.src);
+        if (response.ok) job = await response.json();
+    } catch (error) {
+        //Retried below like a failed response
+    }
+    if (!job) {
+        failures++;
+        if (failures < 5) {
+            setTimeout(poll, 1000 * 2 ** failures);
+        } else {
+            status.textContent = 'Lost track of this job. Reload the page to check on it.';
+        }
+        return;
+    }
+    failures = 0;
+    if (status.dataset.mode === 'reload') {
+        if (job.status !== 'running') {
+            window.location.reload();
+            return;
+        }
+        status.innerHTML = describe(job.progress);
+    } else {
+        showUpload(job);
+    }
+    if (job.status === 'running') setTimeout(poll, 1000);
+}
+
+poll();
@@ -0,0 +1,37 @@
+//Track selection and "Load more" for the new song search page
+const loadMoreButton = document.getElementById('load-more');
+let nextOffset = loadMoreButton.dataset.nextOffset;
+
+function selectAll() {
+    document.querySelectorAll('input[type="checkbox"]').forEach(cb => cb.checked = true);
+}
+
+function deselectAll() {
+    document.querySelectorAll('input[type="checkbox"]').forEach(cb => cb.checked = false);
+}
+
+async function loadMore() {
+    const params = new URLSearchParams({
+        genre: loadMoreButton.dataset.genre,
+        offset: nextOffset,
+        market: loadMoreButton.dataset.market
+    });
+    const page = await (await fetch(loadMoreButton.dataset.src + '?' + params)).json();
+    const list = document.getElementById('tracks');
+    for (const track of page.tracks) {
+        const id = 'track' + list.children.length;
+        const item = document.createElement('div');
+        item.className = 'track-item';
+        item.innerHTML = `<input type="checkbox" name="tracks" id="${id}"><label for="${id}"><strong></strong><br><small></small></label>`;
+        item.querySelector('input').value = track.uri;
+        item.querySelector('strong').textContent = track.name;
+        item.querySelector('small').textContent = track.artists;
+        list.appendChild(item);
+    }
+    nextOffset = page.next_offset;
+    if (nextOffset === null) loadMoreButton.style.display = 'none';
+}
+
+document.getElementById('select-all').addEventListener('click', selectAll);
+document.getElementById('deselect-all').addEventListener('click', deselectAll);
+loadMoreButton.addEventListener('click', loadMore);